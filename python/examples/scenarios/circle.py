@@ -20,6 +20,7 @@ class CircleScenario:
         self._speed = speed
         self._live = live
         self._metadata = None
+        self._builder = None
 
     def get_metadata(self):
         if not self._metadata:
@@ -72,6 +73,7 @@ class CircleScenario:
                 builder.start_time(log_start_time)\
                     .end_time(log_start_time + self._duration)
             self._metadata = builder.get_message()
+            self._builder = None
 
         if self._live:
             return {
@@ -84,10 +86,14 @@ class CircleScenario:
     def get_message(self, time_offset):
         timestamp = self._timestamp + time_offset
 
-        builder = xviz_avs.XVIZBuilder(metadata=self._metadata)
+        # Reuse one builder for the whole session
+        if self._builder is None:
+            self._builder = xviz_avs.XVIZBuilder(metadata=self._metadata)
+        builder = self._builder
         self._draw_pose(builder, timestamp)
         self._draw_grid(builder)
         data = builder.get_message()
+        builder.reset()
 
         if self._live:
             return {
@@ -5,41 +5,30 @@ sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
 import xviz_avs
 from xviz_avs.builder import XVIZBuilder, XVIZMetadataBuilder
-from xviz_avs.server import XVIZServer, XVIZBaseSession
+from xviz_avs.server import XVIZServer, XVIZBroadcaster, XVIZBroadcastSession
 
 from scenarios.circle import CircleScenario
 
 
-class ScenarioSession(XVIZBaseSession):
-    def __init__(self, socket, request, scenario=CircleScenario()):
-        super().__init__(socket, request)
-        self._scenario = scenario
-        self._socket = socket
+async def produce_frames(scenario):
+    '''
+    Build and encode each frame once, it's sent to all the connected clients
+    '''
+    t = 0
+    while True:
+        message = scenario.get_message(t)
+        yield json.dumps(message)
 
-    def on_connect(self):
-        print("Connected!")
- 
-    def on_disconnect(self):
-        print("Disconnect!")
-
-    async def main(self):
-        metadata = self._scenario.get_metadata()
-        await self._socket.send(json.dumps(metadata))
-
-        t = 0
-        while True:
-            message = self._scenario.get_message(t)
-            await self._socket.send(json.dumps(message))
-
-            t += 0.5
-            await asyncio.sleep(0.5)
+        t += 0.5
+        await asyncio.sleep(0.5)
 
 class ScenarioHandler:
-    def __init__(self):
-        pass
+    def __init__(self, scenario=CircleScenario()):
+        self._broadcaster = XVIZBroadcaster(lambda: produce_frames(scenario),
+            metadata=json.dumps(scenario.get_metadata()))
 
     def __call__(self, socket, request):
-        return ScenarioSession(socket, request)
+        return XVIZBroadcastSession(socket, request, self._broadcaster)
 
 if __name__ == "__main__":
     handler = logging.StreamHandler(sys.stdout)
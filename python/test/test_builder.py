@@ -1,7 +1,15 @@
 import json
+import os
+import sys
+import threading
+import timeit
+import numpy as np
 from easydict import EasyDict as edict
 
-from xviz_avs.builder import XVIZBuilder, XVIZUIPrimitiveBuilder, XVIZTimeSeriesBuilder, XVIZVariableBuilder
+from xviz_avs.builder import XVIZBuilder, XVIZUIPrimitiveBuilder, XVIZTimeSeriesBuilder, XVIZVariableBuilder,\
+    XVIZMetadataBuilder, CATEGORY, PRIMITIVE_TYPES, SCALAR_TYPE, VALIDATION_MODES
+from xviz_avs.builder import base_builder
+from xviz_avs.builder.base_builder import build_object_style, build_stream_style, STYLE_CACHE_SIZE
 import unittest
 
 PRIMARY_POSE_STREAM = '/vehicle_pose'
@@ -126,6 +134,257 @@ class TestPrimitiveBuilder(unittest.TestCase):
         assert json.dumps(data, sort_keys=True) == json.dumps(expected, sort_keys=True)
 
 
+    def test_polygons_batch(self):
+        verts = [[0., 0., 0., 4., 0., 0., 4., 3., 0.], [1., 1., 1., 2., 2., 2., 3., 3., 3.]]
+        for i in range(2):
+            self.builder.primitive('/test/polygon')\
+                .polygon(verts[i])\
+                .id(str(i))\
+                .classes(['car'])\
+                .style({'fill_color': [255, 0, 0]})
+        expected = self.builder.get_data().to_object()
+
+        builder = XVIZBuilder()
+        setup_pose(builder)
+        builder.primitive('/test/polygon')\
+            .polygons(np.array(verts).reshape(2, 3, 3), ids=['0', '1'], classes=[['car'], ['car']],
+                      styles={'fill_color': [255, 0, 0]})
+        assert builder.get_data().to_object() == expected
+
+        builder = XVIZBuilder()
+        setup_pose(builder)
+        builder.primitive('/test/polygon')\
+            .polygons(np.array(verts).reshape(-1, 3), offsets=[0, 3, 6], ids=['0', '1'],
+                      classes=[['car'], ['car']], styles=[{'fill_color': [255, 0, 0]}] * 2)
+        assert builder.get_data().to_object() == expected
+
+    def test_polygons_batch_numpy_ids(self):
+        verts = np.zeros((3, 1, 3))
+        classes = np.array([['car', 'moving'], ['car', 'parked'], ['bike', 'moving']])
+        self.builder.primitive('/test/polygon')\
+            .polygons(verts, ids=np.arange(3), classes=classes)
+        self.builder.primitive('/test/polyline')\
+            .polylines(verts, ids=np.array(['a', 'b', 'c']), classes=[classes[0], None, []])
+        primitives = self.builder.get_data().to_object()['primitives']
+
+        polygons = primitives['/test/polygon']['polygons']
+        assert [p['base']['object_id'] for p in polygons] == ['0', '1', '2']
+        assert [p['base']['classes'] for p in polygons] == classes.tolist()
+        polylines = primitives['/test/polyline']['polylines']
+        assert [p['base'] for p in polylines] == [
+            {'object_id': 'a', 'classes': ['car', 'moving']}, {'object_id': 'b'}, {'object_id': 'c'}]
+
+    def test_batch_then_stream(self):
+        self.builder.primitive('/test/polygon').polygons([[0., 0., 0.]])
+        self.builder.primitive('/test/polyline').polyline([1., 1., 1.])
+        primitives = self.builder.get_data().to_object()['primitives']
+        assert primitives['/test/polygon']['polygons'] == [{'vertices': [0., 0., 0.]}]
+        assert primitives['/test/polyline']['polylines'] == [{'vertices': [1., 1., 1.]}]
+
+    def test_batch_after_primitive(self):
+        self.builder.primitive('/test/polygon')\
+            .polygon([0., 0., 0.])\
+            .polygons(np.array([[[1., 1., 1.]], [[2., 2., 2.]]]))
+        polygons = self.builder.get_data().to_object()['primitives']['/test/polygon']['polygons']
+        assert polygons == [{'vertices': [0., 0., 0.]}, {'vertices': [1., 1., 1.]},
+                            {'vertices': [2., 2., 2.]}]
+
+    def test_polylines_batch_mismatch(self):
+        with self.assertLogs('xviz', level='ERROR'):
+            self.builder.primitive('/test/polyline').polylines([[0., 0., 0.]], ids=['0', '1'])
+        assert self.builder.get_data().to_object().get('primitives') is None
+
+    def test_points_numpy(self):
+        verts = [0., 0., 0., 1., 2., 3., 4., 5., 6.]
+        colors = [255, 0, 0, 0, 255, 0, 0, 0, 255]
+        self.builder.primitive('/test/points').points(verts).colors(colors)
+        self.builder.primitive('/test/points')\
+            .points(np.array(verts, dtype=np.float32).reshape(3, 3))\
+            .colors(np.array(colors, dtype=np.uint8).reshape(3, 3))
+
+        points = self.builder.get_data().to_object()['primitives']['/test/points']['points']
+        assert len(points) == 2
+        assert points[0] == points[1]
+        assert points[1]['points'] == verts
+
+    def test_points_numpy_invalid_shape(self):
+        with self.assertLogs('xviz', level='ERROR'):
+            self.builder.primitive('/test/points').points(np.zeros((3, 2), dtype=np.float32))
+        with self.assertLogs('xviz', level='ERROR'):
+            self.builder.primitive('/test/points').points(np.zeros((3, 3), dtype=np.float32))\
+                .colors(np.zeros((3, 5), dtype=np.uint8))
+        with self.assertLogs('xviz', level='ERROR'):
+            self.builder.primitive('/test/points').points(np.zeros((3, 3), dtype=np.float32))\
+                .colors(np.zeros((2, 4), dtype=np.uint8))
+            self.builder.get_data()
+
+    def test_points_numpy_colors_range(self):
+        verts = np.zeros((2, 3), dtype=np.float32)
+        self.builder.primitive('/test/points').points(verts)\
+            .colors(np.array([[255, 0, 0], [0, 128, 0]], dtype=np.int64))
+        with self.assertLogs('xviz', level='ERROR'):
+            self.builder.primitive('/test/points').points(verts)\
+                .colors(np.array([[256, 0, 0], [0, 128, 0]], dtype=np.int64))
+        with self.assertLogs('xviz', level='ERROR'):
+            self.builder.primitive('/test/points').points(verts)\
+                .colors(np.ones((2, 3), dtype=np.float32))
+
+        points = self.builder.get_data().data.primitives['/test/points'].points
+        assert points[0].colors == bytes([255, 0, 0, 0, 128, 0])
+        assert points[1].colors == b'' and points[2].colors == b''
+
+class TestBuilderReset(unittest.TestCase):
+    def _build_frame(self, builder, i):
+        builder.pose(PRIMARY_POSE_STREAM).timestamp(float(i)).position(i, 0., 0.)
+        builder.primitive('/test/polygon').polygon([0., 0., 0., 4., 0., i]).id(str(i))
+        builder.future_instance('/test/future', float(i)).circle([i, 0., 0.], 1.)
+        builder.variable('/test/variable').values([i])
+        builder.time_series('/test/time_series').timestamp(float(i)).value(i)
+        builder.ui_primitives('/test/treetable').treetable([]).row(i, ['row'])
+        builder.link('/parent', '/child')
+        return builder.get_message().to_object()
+
+    def test_reuse(self):
+        builder = XVIZBuilder()
+        for i in range(1, 4):
+            expected = self._build_frame(XVIZBuilder(), i)
+            assert self._build_frame(builder, i) == expected
+            builder.reset()
+
+    def test_reset_drops_data(self):
+        builder = XVIZBuilder()
+        self._build_frame(builder, 1)
+        builder.reset()
+        builder.timestamp(2.)
+        assert builder.get_data().to_object() == {'timestamp': 2.}
+
+class TestBuilderValidation(unittest.TestCase):
+    def setUp(self):
+        builder = XVIZMetadataBuilder()
+        builder.stream(PRIMARY_POSE_STREAM).category(CATEGORY.POSE)
+        builder.stream('/test/polygon').category(CATEGORY.PRIMITIVE).type(PRIMITIVE_TYPES.POLYGON)
+        builder.stream('/test/variable').category(CATEGORY.VARIABLE).type(SCALAR_TYPE.FLOAT)
+        self.metadata = builder.get_message()
+
+    def _get_warnings(self, validation):
+        builder = XVIZBuilder(metadata=self.metadata, validation=validation)
+        setup_pose(builder)
+        with self.assertLogs('xviz', level='WARNING') as logs:
+            builder.primitive('/test/polygon').polygon([0., 0., 0.]).style({'radius': 1})
+            builder.primitive('/test/variable').polygon([0., 0., 0.])
+            builder.primitive('/test/undefined').polygon([0., 0., 0.])
+            builder.get_data()
+            builder._logger.warning('done')
+        return logs.output
+
+    def test_modes(self):
+        metadata_warnings = [
+            "WARNING:xviz:Stream /test/variable category 'PRIMITIVE' does not match metadata"
+            " definition (VARIABLE).",
+            "WARNING:xviz:/test/undefined is not defined in metadata.",
+            "WARNING:xviz:done",
+        ]
+        # style properties are only checked in strict mode
+        assert self._get_warnings('full') == metadata_warnings
+        assert self._get_warnings('compiled') == metadata_warnings
+        assert self._get_warnings('strict') == [
+            "WARNING:xviz:Invalid style properties radius for stream /test/polygon"
+        ] + metadata_warnings
+        assert self._get_warnings('none') == ["WARNING:xviz:done"]
+
+    def test_batch_styles(self):
+        for validation in VALIDATION_MODES:
+            builder = XVIZBuilder(metadata=self.metadata, validation=validation)
+            setup_pose(builder)
+            with self.assertLogs('xviz', level='WARNING') as logs:
+                builder.primitive('/test/polygon').polygons([[0., 0., 0.]], styles={'radius': 1})
+                builder.primitive('/test/polygon').polygons([[0., 0., 0.]], styles=[{'radius': 1}])
+                builder._logger.warning('done')
+            if validation == 'strict':
+                assert logs.output == ["WARNING:xviz:Invalid style properties radius for stream "
+                                       "/test/polygon"] * 2 + ["WARNING:xviz:done"]
+            else:
+                assert logs.output == ["WARNING:xviz:done"]
+
+    def test_invalid_mode(self):
+        with self.assertRaises(ValueError):
+            XVIZBuilder(validation='unknown')
+        with self.assertRaises(ValueError):
+            XVIZBuilder().primitive('/test/polygon').set_validation('unknown')
+
+    @unittest.skipUnless(os.environ.get('XVIZ_BENCHMARK'), "set XVIZ_BENCHMARK to run")
+    def test_benchmark(self):
+        def build(validation):
+            builder = XVIZBuilder(metadata=self.metadata, validation=validation)
+            setup_pose(builder)
+            for i in range(1000):
+                builder.primitive('/test/polygon').polygon([0., 0., 0., 1., 1., 1.])\
+                    .style({'fill_color': [255, 0, 0]}).id(str(i))
+            builder.get_data()
+
+        for validation in VALIDATION_MODES:
+            cost = timeit.timeit(lambda: build(validation), number=3) / 3 * 1000
+            builder = XVIZBuilder(metadata=self.metadata, validation=validation)
+            primitive = builder.primitive('/test/polygon').polygon([0., 0., 0.]).style({'fill_color': [255, 0, 0]})
+            validate = timeit.timeit(primitive._validate, number=10000) * 100
+            print("%s validation: %.2f us per primitive, %.2f us in validation" %
+                  (validation, cost, validate if validation != 'none' else 0))
+            if validation == 'full':
+                full_validate = validate
+            elif validation == 'compiled':
+                assert validate < full_validate
+
+class TestStyleCache(unittest.TestCase):
+    def test_input_not_modified(self):
+        style = {'fill_color': [255, 0, 0], 'stroke_color': [0, 255, 0], 'height': 2.0}
+        built = build_object_style(style)
+        assert style == {'fill_color': [255, 0, 0], 'stroke_color': [0, 255, 0], 'height': 2.0}
+        assert built.fill_color == b'\xff\x00\x00'
+        assert build_stream_style(style).stroke_color == b'\x00\xff\x00'
+
+    def test_cached(self):
+        style = {'fill_color': [1, 2, 3], 'height': 1.0}
+        built = build_object_style(style)
+        assert build_object_style(style) is built
+        assert build_object_style(dict(style)) is built
+        assert build_stream_style(style) is not built
+
+        # the cache follows changes made by the caller
+        style['fill_color'][0] = 4
+        assert build_object_style(style).fill_color == b'\x04\x02\x03'
+
+    def test_bounded(self):
+        for i in range(STYLE_CACHE_SIZE * 2):
+            assert build_object_style({'height': float(i)}).height == i
+            assert len(base_builder._style_content_cache) <= STYLE_CACHE_SIZE
+            assert len(base_builder._style_identity_cache) <= STYLE_CACHE_SIZE
+
+    def test_least_recently_used(self):
+        frequent = {'height': -1.0}
+        built = build_object_style(frequent)
+        for i in range(STYLE_CACHE_SIZE * 2):
+            build_object_style({'height': float(i)})
+            # the style used in every frame stays cached while the others are evicted
+            assert build_object_style({'height': -1.0}) is built
+
+    def test_threads(self):
+        styles = [{'height': float(i % 300)} for i in range(3000)]
+        results = {}
+        def build(index):
+            results[index] = [build_object_style(style).height for style in styles]
+
+        threads = [threading.Thread(target=build, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        expected = [style['height'] for style in styles]
+        assert all(results[i] == expected for i in range(4))
+
+    def test_unhashable(self):
+        style = {'fill_color': np.array([1, 2, 3], dtype=np.uint8)}
+        assert build_object_style(style).fill_color == b'\x01\x02\x03'
+
 class TestUIPrimitiveBuilder(unittest.TestCase):
     def setUp(self):
         self.builder = XVIZBuilder()
@@ -211,6 +470,31 @@ class TestUIPrimitiveBuilder(unittest.TestCase):
         }
         assert data['ui_primitives'] == expected
 
+    def test_treetable_deep(self):
+        depth = sys.getrecursionlimit() * 2
+        row = self.builder.ui_primitives('/test').treetable([]).row(1, ['1'])
+        for i in range(2, depth + 1):
+            row = row.child(i, [str(i)])
+        nodes = self.builder.get_data().data.ui_primitives['/test'].treetable.nodes
+        assert [node.id for node in nodes] == list(range(1, depth + 1))
+        assert nodes[-1].parent == depth - 1
+
+    def test_treetable_bulk_rows(self):
+        TEST_COLUMNS = [{'display_text': 'Name', 'type': 'STRING'}]
+        table = self.builder.ui_primitives('/test').treetable(TEST_COLUMNS)
+        table.row(1, ['Test Row 1']).child(2, ['Test Row 2'])
+        table.row(10, ['Test Row 10']).child(20, ['Test Row 20'])
+        table.row(30, [30])
+        expected = self.builder.get_data().to_object()
+
+        builder = XVIZBuilder()
+        setup_pose(builder)
+        table = builder.ui_primitives('/test').treetable(TEST_COLUMNS)
+        table.row(1, ['Test Row 1']).child(2, ['Test Row 2'])
+        table.rows(np.array([10, 20]), np.array([0, 10]), [['Test Row 10'], ['Test Row 20']])
+        table.rows([30], [None], [[30]])
+        assert builder.get_data().to_object() == expected
+
     def test_treetable_row_children_creation_order(self):
         TEST_COLUMNS = [{'display_text': 'Name', 'type': 'STRING'}]
         table = self.builder.ui_primitives('/test').treetable(TEST_COLUMNS)
@@ -324,6 +608,63 @@ class TestTimeSeriesBuilder(unittest.TestCase):
         data = self.builder.get_data().to_object()
         assert json.dumps(data['time_series'], sort_keys=True) == json.dumps(expected, sort_keys=True)
 
+    def test_columns(self):
+        entries = [('/a', 20., 1., None), ('/b', 21., 2., 'id-1'), ('/c', 20., 3., None),
+                   ('/d', 21., 4., 'id-1'), ('/e', 21., 5., 'id-2'), ('/f', 20., 6., 'id-2'),
+                   ('/g', 20., 7, None)]
+        for stream_id, timestamp, value, id_ in entries:
+            builder = self.builder.time_series(stream_id).timestamp(timestamp).value(value)
+            if id_:
+                builder.id(id_)
+        expected = self.builder.get_data().to_object()['time_series']
+
+        builder = XVIZBuilder()
+        setup_pose(builder)
+        streams, timestamps, values, ids = zip(*entries[:-1])
+        builder.time_series_columns(streams, np.array(timestamps), np.array(values), list(ids))
+        builder.time_series_columns(['/g'], 20., [7])
+        assert builder.get_data().to_object()['time_series'] == expected
+
+        builder = XVIZBuilder()
+        setup_pose(builder)
+        builder.time_series_columns(['/a', '/b'], 20., [1., 2.], [None, 'x'])
+        assert builder.get_data().to_object()['time_series'] == [
+            {'timestamp': 20., 'streams': ['/a'], 'values': {'doubles': [1.]}},
+            {'timestamp': 20., 'streams': ['/b'], 'values': {'doubles': [2.]}, 'object_id': 'x'},
+        ]
+
+    def test_order(self):
+        # entries are grouped by timestamp, then object id, then value type
+        entries = [('/a', 1., 1., 'A'), ('/b', 2., 2., 'A'), ('/c', 1., 3., 'B'), ('/d', 1., 'x', 'A')]
+        expected = [
+            {'timestamp': 1., 'streams': ['/a'], 'values': {'doubles': [1.]}, 'object_id': 'A'},
+            {'timestamp': 1., 'streams': ['/d'], 'values': {'strings': ['x']}, 'object_id': 'A'},
+            {'timestamp': 1., 'streams': ['/c'], 'values': {'doubles': [3.]}, 'object_id': 'B'},
+            {'timestamp': 2., 'streams': ['/b'], 'values': {'doubles': [2.]}, 'object_id': 'A'},
+        ]
+        for stream_id, timestamp, value, id_ in entries:
+            self.builder.time_series(stream_id).timestamp(timestamp).value(value).id(id_)
+        assert self.builder.get_data().to_object()['time_series'] == expected
+
+        builder = XVIZBuilder()
+        setup_pose(builder)
+        streams, timestamps, values, ids = zip(*entries[:-1])
+        builder.time_series_columns(streams, timestamps, values, ids)
+        builder.time_series('/d').timestamp(1.).value('x').id('A')
+        assert builder.get_data().to_object()['time_series'] == expected
+
+    def test_columns_mixed_types(self):
+        self.builder.time_series_columns(['/a', '/b', '/c'], 20., [1., 'x', 2.])
+        data = self.builder.get_data().to_object()['time_series']
+        assert data == [
+            {'timestamp': 20., 'streams': ['/a', '/c'], 'values': {'doubles': [1., 2.]}},
+            {'timestamp': 20., 'streams': ['/b'], 'values': {'strings': ['x']}},
+        ]
+
+    def test_columns_length_mismatch(self):
+        with self.assertLogs('xviz', level='ERROR'):
+            self.builder.time_series_columns(['/a', '/b'], 20., [1.])
+
 class TestFutureInstanceBuilder(unittest.TestCase):
     def setUp(self):
         self.builder = XVIZBuilder()
@@ -540,6 +881,41 @@ class TestFutureInstanceBuilder(unittest.TestCase):
         assert data == expected
 
 
+    def test_trajectories(self):
+        timestamps = [1.2, 1.0, 1.1]
+        positions = np.arange(3 * 2 * 3, dtype=np.float32).reshape(3, 2, 3)
+        for t, timestamp in enumerate(timestamps):
+            for n, id_ in enumerate(['a', 'b']):
+                self.builder.future_instance('/test/future_points', timestamp)\
+                    .points(positions[t, n].tolist())\
+                    .id(id_)\
+                    .classes(['car'])
+        self.builder.future_instance('/test/future_points', 1.05).points([0., 0., 0.])
+        expected = self.builder.get_data().to_object()
+
+        builder = XVIZBuilder()
+        setup_pose(builder)
+        builder.future_instance('/test/future_points', 1.05).points([0., 0., 0.])
+        builder.future_instance('/test/future_points')\
+            .trajectories(timestamps, positions, ids=['a', 'b'], classes=[['car'], ['car']])
+        data = builder.get_data().to_object()
+        assert data == expected
+        assert data['future_instances']['/test/future_points']['timestamps'] == [1.0, 1.05, 1.1, 1.2]
+
+    def test_trajectories_polygons(self):
+        positions = np.zeros((2, 3, 4, 3))
+        self.builder.future_instance('/test/future_polygon').trajectories([1.0, 2.0], positions)
+        futures = self.builder.get_data().to_object()['future_instances']['/test/future_polygon']
+        assert futures['timestamps'] == [1.0, 2.0]
+        assert [len(p['polygons']) for p in futures['primitives']] == [3, 3]
+        assert futures['primitives'][0]['polygons'][0]['vertices'] == [0.] * 12
+
+    def test_trajectories_invalid_shape(self):
+        with self.assertLogs('xviz', level='ERROR'):
+            self.builder.future_instance('/test/future_points').trajectories([1.0], np.zeros((2, 3, 3)))
+        with self.assertLogs('xviz', level='ERROR'):
+            self.builder.future_instance('/test/future_points').trajectories([1.0], np.zeros((1, 3, 3)), ids=['a'])
+
 class TestVariableBuilder(unittest.TestCase):
     def setUp(self):
         self.builder = XVIZBuilder()
@@ -683,6 +1059,28 @@ class TestVariableBuilder(unittest.TestCase):
 
         assert data == expected
 
+    def test_duplicate_id(self):
+        self.builder.variable('/test_var').values([1]).id('id-1')
+        self.builder.variable('/test_var').values([2]).id('id-1')
+        with self.assertRaises(Exception):
+            self.builder.get_data()
+
+    def test_values_by_id(self):
+        self.builder.variable('/test_var').values([1.0])
+        self.builder.variable('/test_var').values([1.0, 2.0]).id('id-1')
+        self.builder.variable('/test_var').values(['a']).id('id-2')
+        self.builder.variable('/test_var').values([3]).id('id-3')
+        expected = self.builder.get_data().to_object()
+
+        builder = XVIZBuilder()
+        setup_pose(builder)
+        builder.variable('/test_var').values([1.0])\
+            .values_by_id({'id-1': np.array([1.0, 2.0]), 'id-2': ['a'], 'id-3': (3,)})
+        assert builder.get_data().to_object() == expected
+
+        with self.assertRaises(Exception):
+            builder.variable('/test_var').values_by_id({'id-3': [4]})
+
 # No pose should not error
 class TestOnlyPrimitiveBuilder(unittest.TestCase):
     def setUp(self):
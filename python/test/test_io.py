@@ -1,7 +1,50 @@
+import array
+import base64
+import copy
+import io
 import json
+import os
+import threading
+import timeit
+from unittest import mock
+import numpy as np
+import pytest
 import xviz_avs as xa
 import xviz_avs.io as xi
 import xviz_avs.builder as xb
+import xviz_avs.io.json as xjson
+import xviz_avs.io.gltf as xgltf
+from google.protobuf.json_format import MessageToDict
+from xviz_avs.io.protobuf import PBE_MAGIC
+from xviz_avs.message import XVIZEnvelope, StateUpdate, _unravel_style_object
+from xviz_avs.v2.envelope_pb2 import Envelope
+from xviz_avs.v2.primitives_pb2 import Polygon
+
+class _TrackedMemorySource(xi.MemorySource):
+    def __init__(self):
+        super().__init__()
+        self.reads = []
+
+    def read(self, name=None):
+        self.reads.append(name)
+        return super().read(name)
+
+class _FailingGLBWriter(xi.XVIZGLBWriter):
+    # defined at module level to be used in worker processes
+    def _encode_message(self, message):
+        data = message.readonly_data
+        if isinstance(data, StateUpdate) and data.updates[0].timestamp == 3.:
+            raise ValueError("cannot encode")
+        return super()._encode_message(message)
+
+class _BlockingMemorySource(xi.MemorySource):
+    def __init__(self):
+        super().__init__()
+        self.release = threading.Event()
+
+    def write(self, data, name=None):
+        self.release.wait()
+        super().write(data, name)
 
 class TestIO:
     def _get_metadata_builder(self):
@@ -19,7 +62,7 @@ class TestIO:
             .type(xa.PRIMITIVE_TYPES.IMAGE)
         return builder
 
-    def _get_builder(self, circle=False, points=False, polyline=False, polygon=False):
+    def _get_builder(self, circle=False, points=False, polyline=False, polygon=False, image=False):
         builder = xb.XVIZBuilder()
         builder.pose()\
             .timestamp(2.000000000001)\
@@ -39,6 +82,10 @@ class TestIO:
             builder.primitive('/test_primitive')\
                 .polygon([1, 1, 1, 2, 2, 2, 3, 3, 3, 4, 4, 4, 1, 1, 1])\
                 .style({'height': 2.0})
+        if image:
+            builder.primitive('/test_primitive')\
+                .image(b'\x89PNG\r\n')\
+                .dimensions(2, 1)
         return builder
 
     def test_message_index(self):
@@ -285,6 +332,90 @@ class TestIO:
 
         assert data == expected
 
+    def test_glb_image_writer(self):
+        builder = self._get_builder(image=True)
+
+        source = xi.MemorySource(latest_only=True)
+        writer = xi.XVIZGLBWriter(source)
+        writer.write_message(builder.get_message())
+        data = source.read()
+
+        expected = b'glTF\x02\x00\x00\x00\xac\x02\x00\x00\x88\x02\x00\x00JSON{"asset":{"version":"2"'\
+            b'},"buffers":[{"byteLength":8}],"bufferViews":[{"buffer":0,"byteOffset":0,"byteLength'\
+            b'":6}],"accessors":[],"images":[{"bufferView":0,"mimeType":"image/png","width":2,"heig'\
+            b'ht":1}],"meshes":[],"extensions":{"AVS_xviz":{"type":"xviz/state_update","data":{"upd'\
+            b'ate_type":"INCREMENTAL","updates":[{"timestamp":2.000000000001,"poses":{"/vehicle_pos'\
+            b'e":{"timestamp":2.000000000001,"map_origin":{"longitude":4.4,"latitude":5.5,"altitude'\
+            b'":6.6},"position":[44.0,55.0,66.0],"orientation":[0.44,0.55,0.66]}},"primitives":{"/t'\
+            b'est_primitive":{"images":[{"data":"#/images/0","width_px":2,"height_px":1}]}}}]}}},"e'\
+            b'xtensionsUsed":["AVS_xviz"]}   \x08\x00\x00\x00BIN\x00\x89PNG\r\n\x00\x00'
+
+        assert data == expected
+
+    def test_glb_reader(self):
+        metadata_builder = self._get_metadata_builder()
+        builder = self._get_builder(points=True)
+        builder.primitive('/test_image').image(b'\x89PNG\r\n').dimensions(2, 1)
+
+        source = xi.MemorySource()
+        writer = xi.XVIZGLBWriter(source)
+        writer.write_message(metadata_builder.get_message())
+        writer.write_message(builder.get_message())
+        writer._write_message_index()
+
+        reader = xi.XVIZGLBReader(source)
+        assert reader.message_count() == 1
+        assert reader.read_metadata()['type'] == 'xviz/metadata'
+
+        message = reader.read_message(0)
+        assert message['type'] == 'xviz/state_update'
+        primitives = message['data']['updates'][0]['primitives']
+
+        points = primitives['/test_primitive']['points'][0]
+        assert points['points'].dtype == np.float32
+        assert points['points'].shape == (3, 3)
+        assert points['points'].tolist() == [[0, 0, 0], [1, 1, 1], [2, 2, 2]]
+        assert points['colors'].dtype == np.uint8
+        assert points['colors'].tolist() == [[255, 0, 0, 128], [0, 255, 0, 128], [0, 0, 255, 128]]
+
+        image = primitives['/test_image']['images'][0]
+        assert image['data'].tobytes() == b'\x89PNG\r\n'
+        assert image['width_px'] == 2
+
+        # arrays are views over the buffer read from the source
+        assert not points['points'].flags.owndata
+        assert not image['data'].flags.owndata
+        reader.close()
+
+    def test_gltf_builder_buffers(self):
+        points = np.arange(9, dtype=np.float32)
+        colors = array.array('B', [1, 2, 3, 4, 5, 6])
+        image = b'\x89PNG\r\n'
+
+        builder = xgltf.GLTFBuilder()
+        assert builder.add_buffer(points, size=3) == 0
+        assert builder.add_buffer(colors, size=3) == 1
+        assert builder.add_buffer(memoryview(points[:3]), size=3) == 2
+        vertices = np.arange(30, dtype=np.float32).reshape(10, 3)
+        assert builder.add_buffer(memoryview(vertices), size=3) == 3
+        builder.add_image(xgltf.ImageWrapper(image, 2, 1, 'image/png'))
+
+        # buffers are referenced instead of copied, padding is a separate segment
+        assert builder._source_buffers[0].obj is points
+        assert builder._source_buffers[1].obj is colors
+        assert bytes(builder._source_buffers[2]) == b'\x00' * 2
+
+        output = io.BytesIO()
+        builder.flush(output)
+        parser = xgltf.GLTFParser(output.getvalue())
+        assert parser.get_accessor(0).tolist() == points.reshape(3, 3).tolist()
+        assert parser.get_accessor(1).tolist() == [[1, 2, 3], [4, 5, 6]]
+        assert parser.get_accessor(2).tolist() == [[0, 1, 2]]
+        assert parser.json['accessors'][3]['count'] == 10
+        assert parser.get_accessor(3).tolist() == vertices.tolist()
+        assert parser.get_image(0).tobytes() == image
+        assert len(parser.binary) % 4 == 0
+
     def test_protobuf_normal_writer(self):
         builder = self._get_builder(circle=True)
 
@@ -303,3 +434,444 @@ class TestIO:
             b'["AVS_xviz"]}\x00\x00\x00\x00\x00\x00BIN\x00'
 
         # XXX: assert data == expected
+
+    def test_protobuf_reader(self):
+        metadata_builder = self._get_metadata_builder()
+        builder_message = self._get_builder(circle=True).get_message()
+
+        source = xi.MemorySource()
+        writer = xi.XVIZProtobufWriter(source)
+        writer.write_message(metadata_builder.get_message())
+        writer.write_message(builder_message)
+        writer._write_message_index()
+
+        reader = xi.XVIZProtobufReader(source)
+        assert reader.message_count() == 1
+
+        metadata = reader.read_metadata()
+        assert metadata.type == 'xviz/metadata'
+        assert metadata.message.data == metadata_builder.get_message().data
+
+        message = reader.read_message(0)
+        assert message.type == 'xviz/state_update'
+        assert not message.has_message()
+        assert message.message.data == builder_message.data
+        assert message.has_message()
+
+    def test_protobuf_reader_no_envelope(self):
+        builder_message = self._get_builder(circle=True).get_message()
+
+        source = xi.MemorySource()
+        writer = xi.XVIZProtobufWriter(source, wrap_envelope=False)
+        writer.write_message(builder_message)
+
+        reader = xi.XVIZProtobufReader(source, wrap_envelope=False)
+        message = reader.read_message(0)
+        assert message.type == 'xviz/state_update'
+        assert message.message.data == builder_message.data
+
+    def test_message_encoding_cache(self):
+        message = self._get_builder(circle=True).get_message()
+        serialized = message.to_bytes()
+        assert message.to_bytes() is serialized
+        assert message.to_bytes(wrap_envelope=True) is message.to_bytes(wrap_envelope=True)
+        assert XVIZEnvelope(message).readonly_data.data.value == serialized
+
+        # the message is encoded once for multiple writers
+        for writer_class in [xi.XVIZJsonWriter, xi.XVIZGLBWriter, xi.XVIZProtobufWriter]:
+            sources = [xi.MemorySource(), xi.MemorySource()]
+            data = [source._data for source in sources]
+            for source in sources:
+                writer_class(source).write_message(message)
+            assert data[0] == data[1]
+        assert message.to_bytes() is serialized
+
+        # modifying the message drops the cache, also in the envelopes
+        envelope = XVIZEnvelope(message)
+        envelope_bytes = envelope.to_bytes()
+        message.data.updates[0].poses['/vehicle_pose'].timestamp = 3.
+        assert message.to_bytes() is not serialized
+        assert envelope.to_bytes() != envelope_bytes
+        assert envelope.to_message().data.updates[0].poses['/vehicle_pose'].timestamp == 3.
+
+    def test_message_encoding_cache_held_reference(self):
+        message = self._get_builder(circle=True).get_message()
+        pose = message.data.updates[0].poses['/vehicle_pose'] # held before encoding
+        writer = xi.XVIZJsonWriter(xi.MemorySource())
+        encoded = writer._encode_message(message)
+        serialized = message.to_bytes()
+        assert writer._encode_message(message) is encoded
+
+        # the changes of size are detected
+        pose.ClearField('orientation')
+        assert message.to_bytes() != serialized
+        assert b'orientation' not in writer._encode_message(message)
+
+        # the others are not, the cache is dropped explicitly
+        encoded = writer._encode_message(message)
+        pose.timestamp = 3.
+        assert writer._encode_message(message) is encoded
+        message.invalidate()
+        assert b'"timestamp":3.0' in writer._encode_message(message)
+
+        # the message from to_message is shared with the envelope
+        envelope = XVIZEnvelope(XVIZEnvelope(message).readonly_data)
+        unpacked = envelope.to_message()
+        unpacked.data.updates[0].poses['/vehicle_pose'].timestamp = 4.
+        assert XVIZEnvelope(Envelope.FromString(envelope.to_bytes())).to_message().data == \
+            unpacked.data
+
+        # and unpacked again when the envelope is modified directly
+        envelope.data.data.value = message.to_bytes()
+        assert envelope.to_message().data.updates[0].poses['/vehicle_pose'].timestamp == 3.
+
+    def test_protobuf_writer_encoding_cache(self):
+        message = self._get_builder(circle=True).get_message()
+        for wrap_envelope in [False, True]:
+            writer = xi.XVIZProtobufWriter(xi.MemorySource(), wrap_envelope=wrap_envelope)
+            encoded = writer._encode_message(message)
+            assert encoded[:4] == PBE_MAGIC
+
+            # the second encoding neither serializes nor checks the message
+            calls = []
+            def count(message_class, name):
+                method = getattr(message_class, name)
+                return lambda self, *args, **kwargs: calls.append(name) or method(self, *args, **kwargs)
+            with mock.patch.object(StateUpdate, 'SerializeToString', count(StateUpdate, 'SerializeToString')), \
+                 mock.patch.object(StateUpdate, 'ByteSize', count(StateUpdate, 'ByteSize')), \
+                 mock.patch.object(Envelope, 'SerializeToString', count(Envelope, 'SerializeToString')):
+                assert writer._encode_message(message) is encoded
+                assert xi.XVIZProtobufWriter(xi.MemorySource(), wrap_envelope=wrap_envelope)\
+                    ._encode_message(message) is encoded
+            assert calls == []
+
+    def test_protobuf_reader_encoding_cache(self):
+        source = xi.MemorySource()
+        data = source._data
+        writer = xi.XVIZProtobufWriter(source)
+        writer.write_message(self._get_builder(circle=True).get_message())
+
+        message = xi.XVIZProtobufReader(source).read_message(0).message
+        assert message.to_bytes(wrap_envelope=True) == data['2-frame.pbe'][4:]
+        assert xi.XVIZProtobufWriter(xi.MemorySource())._encode_message(message) == data['2-frame.pbe']
+
+    def _write_log(self, writer):
+        metadata_builder = self._get_metadata_builder()
+        metadata_builder.start_time(1.0).end_time(10.0)
+
+        writer.write_message(metadata_builder.get_message())
+        for i in range(10):
+            builder = xb.XVIZBuilder()
+            builder.pose().timestamp(1.0 + i)
+            writer.write_message(builder.get_message())
+        writer._write_message_index()
+
+    def test_provider(self):
+        for writer_class in [xi.XVIZJsonWriter, xi.XVIZGLBWriter, xi.XVIZProtobufWriter]:
+            source = _TrackedMemorySource()
+            self._write_log(writer_class(source))
+
+            provider = xi.XVIZProviderFactory().open(source)
+            assert provider is not None and provider.valid()
+            assert provider.time_range() == (1.0, 10.0)
+            assert provider.message_count() == 10
+
+            assert provider.seek(0.) == 0
+            assert provider.seek(3.) == 2
+            assert provider.seek(3.5) == 3
+            assert provider.seek(20.) == 9
+
+            assert list(provider.get_message_iterator(3., 5.)) == [2, 3, 4]
+            assert list(provider.get_message_iterator(3.5, 4.5)) == [3]
+            assert list(provider.get_message_iterator(4.5, 4.6)) == []
+            assert list(provider.get_message_iterator()) == list(range(10))
+
+            source.reads.clear()
+            messages = list(provider.iter_messages(3., 5.))
+            assert len(messages) == 3
+            assert [name.split('.')[0] for name in source.reads] == ['4-frame', '5-frame', '6-frame']
+
+    def test_provider_invalid(self):
+        assert xi.XVIZProviderFactory().open(xi.MemorySource()) is None
+
+    def test_zip_source(self, tmp_path):
+        path = str(tmp_path / 'log.zip')
+        self._write_log(xi.XVIZGLBWriter(xi.ZipSource(path, mode='w')))
+
+        source = xi.ZipSource(path)
+        data = source.read('2-frame.glb')
+        assert isinstance(data, memoryview) # stored members are not copied
+
+        provider = xi.XVIZProviderFactory().open(source)
+        assert provider.message_count() == 10
+        message = next(provider.iter_messages(3., 3.))
+        assert message['data']['updates'][0]['timestamp'] == 3.
+        provider.close()
+
+        # append without rewriting existing members
+        source = xi.ZipSource(path, mode='a')
+        source.write(b'extra', 'extra.bin')
+        source.close()
+
+        source = xi.ZipSource(path)
+        assert bytes(source.read('extra.bin')) == b'extra'
+        assert bytes(source.read('2-frame.glb')) == bytes(data)
+        source.close()
+
+    def test_zip_source_empty(self, tmp_path):
+        # newly created archive without members
+        path = str(tmp_path / 'new.zip')
+        xi.ZipSource(path, mode='w').close()
+        source = xi.ZipSource(path)
+        assert xi.XVIZProviderFactory().open(source) is None
+        source.close()
+
+        # empty file
+        path = str(tmp_path / 'empty.zip')
+        open(path, 'wb').close()
+        source = xi.ZipSource(path)
+        with pytest.raises(KeyError):
+            source.read('1-frame.glb')
+        assert xi.XVIZProviderFactory().open(source) is None
+        source.close()
+
+    def test_sqlite_source(self, tmp_path):
+        path = str(tmp_path / 'log.db')
+        source = xi.SQLiteSource(path, batch_size=4)
+        self._write_log(xi.XVIZGLBWriter(source))
+        source.close()
+
+        source = xi.SQLiteSource(path)
+        assert source.find_messages(3., 5.) == [(2, '4-frame'), (3, '5-frame'), (4, '6-frame')]
+        assert source.find_messages(20., 30.) == []
+
+        provider = xi.XVIZProviderFactory().open(source)
+        assert provider.message_count() == 10
+        message = next(provider.iter_messages(3., 3.))
+        assert message['data']['updates'][0]['timestamp'] == 3.
+        provider.close()
+
+    def test_async_writer(self):
+        for writer_class in [xi.XVIZJsonWriter, xi.XVIZGLBWriter, xi.XVIZProtobufWriter]:
+            sync_source = xi.MemorySource()
+            self._write_log(writer_class(sync_source))
+
+            source = xi.MemorySource()
+            data = source._data
+            writer = writer_class(source, async_workers=2, max_queue_size=4)
+            self._write_log(writer)
+            writer.flush()
+            assert writer.queue_depth == 0
+            assert data == sync_source._data
+
+    def test_async_writer_drop(self):
+        source = _BlockingMemorySource()
+        data = source._data
+        writer = xi.XVIZProtobufWriter(source, async_workers=1, max_queue_size=2, queue_policy='drop')
+
+        results = []
+        for i in range(5):
+            builder = xb.XVIZBuilder()
+            builder.pose().timestamp(1.0 + i)
+            results.append(writer.write_message(builder.get_message()))
+        assert results.count(False) == writer.dropped_count > 0
+        assert writer.queue_depth > 0
+
+        source.release.set()
+        writer.close()
+        timing = json.loads(data['0-frame.json'])['timing']
+        assert [entry[3] for entry in timing] == ['%d-frame' % (i + 2) for i in range(results.count(True))]
+        assert all('%d-frame.pbe' % (i + 2) in data for i in range(results.count(True)))
+
+    def test_writer_index_skips_failed_messages(self):
+        class FailingWriter(xi.XVIZProtobufWriter):
+            def _encode_message(self, message):
+                if message.readonly_data.updates[0].timestamp == 2.:
+                    raise ValueError("cannot encode")
+                return super()._encode_message(message)
+
+        for options in [{}, dict(async_workers=1)]:
+            source = xi.MemorySource()
+            data = source._data
+            writer = FailingWriter(source, **options)
+            for i in range(3):
+                builder = xb.XVIZBuilder()
+                builder.pose().timestamp(1.0 + i)
+                try:
+                    writer.write_message(builder.get_message())
+                    writer.flush()
+                except ValueError:
+                    pass
+            writer.close()
+
+            timing = json.loads(data['0-frame.json'])['timing']
+            assert [entry[0] for entry in timing] == [1., 3.]
+            assert '3-frame.pbe' not in data
+
+    def test_convert_log(self):
+        source = xi.MemorySource()
+        self._write_log(xi.XVIZProtobufWriter(source))
+
+        expected = xi.MemorySource()
+        data = expected._data
+        reader = xi.XVIZProtobufReader(source)
+        writer = xi.XVIZGLBWriter(expected)
+        writer.write_message(reader.read_metadata().message)
+        for i in range(reader.message_count()):
+            writer.write_message(reader.read_message(i).message)
+        writer.close()
+
+        sink = xi.MemorySource()
+        converted = sink._data
+        xi.convert_log(source, sink, xi.XVIZGLBWriter, max_workers=2, max_pending=3)
+        assert converted.keys() == data.keys()
+        assert converted['0-frame.json'] == data['0-frame.json']
+
+        # protobuf map order differs between processes, so compare decoded frames
+        converted_source, expected_source = xi.MemorySource(), xi.MemorySource()
+        converted_source._data, expected_source._data = converted, data
+        converted_reader = xi.XVIZGLBReader(converted_source)
+        expected_reader = xi.XVIZGLBReader(expected_source)
+        assert converted_reader.read_metadata() == expected_reader.read_metadata()
+        for i in range(expected_reader.message_count()):
+            assert converted_reader.read_message(i) == expected_reader.read_message(i)
+
+    def test_convert_messages_matches_sequential(self):
+        # only one entry in each map, so that the encoding doesn't depend on map order
+        metadata_builder = xb.XVIZMetadataBuilder()
+        metadata_builder.stream('/test_points').category(xa.CATEGORY.PRIMITIVE)\
+            .type(xa.PRIMITIVE_TYPES.POINT)
+        messages = [metadata_builder.get_message()]
+        for i in range(6):
+            builder = xb.XVIZBuilder()
+            builder.pose().timestamp(1.0 + i).position(i, 0, 0)
+            builder.primitive('/test_points').points(np.random.rand(30).astype(np.float32))
+            messages.append(builder.get_message())
+
+        for writer_class, options in [(xi.XVIZGLBWriter, {}),
+                                      (xi.XVIZJsonWriter, dict(float_precision=4)),
+                                      (xi.XVIZProtobufWriter, {})]:
+            expected = xi.MemorySource()
+            data = expected._data
+            writer = writer_class(expected, **options)
+            for message in messages:
+                writer.write_message(message)
+            writer.close()
+
+            sink = xi.MemorySource()
+            converted = sink._data
+            xi.convert_messages(messages, sink, writer_class, max_workers=2, max_pending=2,
+                                **options)
+            assert converted == data
+
+    def test_convert_log_closes_sink_on_error(self):
+        source = xi.MemorySource()
+        self._write_log(xi.XVIZProtobufWriter(source))
+
+        sink = xi.MemorySource()
+        with pytest.raises(ValueError, match="cannot encode"):
+            xi.convert_log(source, sink, _FailingGLBWriter, max_workers=2, max_pending=2)
+        assert not hasattr(sink, '_data') # closed
+
+    def test_convert_log_rejects_other_formats(self):
+        source = xi.MemorySource()
+        self._write_log(xi.XVIZJsonWriter(source))
+        with pytest.raises(ValueError, match="protobuf"):
+            xi.convert_log(source, xi.MemorySource())
+
+    def test_json_fast_encoding(self):
+        builder = self._get_builder()
+        vertices = np.random.rand(1000 * 3).astype(np.float32).tolist()
+        builder.primitive('/test_primitive').points(vertices)
+        frame = XVIZEnvelope(builder.get_message()).to_object()
+
+        mixed = {'a': [{'b': 1.123456}, 5, 2.25, [3.3, {'c': 7}], None, 'x'],
+                 'd': [[1.5, 2], [{'e': 0.1234567}]], 'f': 7, 'g': True, 'h': [], 'i': {}}
+        for obj in [frame, mixed]:
+            original = copy.deepcopy(obj)
+            for precision in [2, 10]:
+                assert xjson._dumps_rounded(obj, precision) == \
+                    xjson._dumps_rounded_by_token(obj, precision)
+            assert obj == original # the input is not modified
+
+    @pytest.mark.skipif(not os.environ.get('XVIZ_BENCHMARK'), reason="set XVIZ_BENCHMARK to run")
+    def test_json_fast_encoding_benchmark(self):
+        builder = self._get_builder()
+        vertices = np.random.rand(100000 * 3).astype(np.float32).tolist()
+        builder.primitive('/test_primitive').points(vertices)
+        obj = XVIZEnvelope(builder.get_message()).to_object()
+        assert xjson._dumps_rounded_by_token(obj, 10) == xjson._dumps_rounded(obj, 10)
+
+        slow = timeit.timeit(lambda: xjson._dumps_rounded_by_token(obj, 10), number=3)
+        fast = timeit.timeit(lambda: xjson._dumps_rounded(obj, 10), number=3)
+        print("JSON encoding of 100k vertices: %.1f ms by token, %.1f ms fast" % (slow * 333, fast * 333))
+        assert fast < slow
+
+    def test_message_to_object(self):
+        def unraveled_by_dict(frame):
+            # conversion through MessageToDict, as done before the compiled converters
+            obj = MessageToDict(frame, preserving_proto_field_name=True)
+            for pdata in obj['primitives'].values():
+                for pldata in pdata.get('points', []):
+                    if 'colors' in pldata:
+                        pldata['colors'] = list(base64.b64decode(pldata['colors']))
+                for plist in pdata.values():
+                    for pldata in plist:
+                        if 'style' in pldata.get('base', {}):
+                            _unravel_style_object(pldata['base']['style'])
+            return obj
+
+        builder = self._get_builder(circle=True, points=True, polygon=True, image=True)
+        builder.primitive('/test_points')\
+            .points(np.random.rand(1000, 3).astype(np.float32))\
+            .colors(np.random.randint(0, 256, (1000, 4)))\
+            .style({'fill_color': [255, 0, 0], 'radius': 0.1})
+        builder.primitive('/test_points').points([0, 0, float('inf')]).classes(['inf'])
+        builder.primitive('/test_text').text('text').position([1, 2, 3])\
+            .style({'stroke_color': [0, 0, 255, 128], 'text_anchor': 'END'})
+        builder.variable('/test_variable').values([1, 2]).id('1')
+        builder.time_series('/test_time_series').timestamp(1.).value(0.3)
+        builder.future_instance('/test_future', 1.).points([1, 2, 3]).colors([1, 2, 3])
+        frame = builder.get_data()
+
+        assert frame.to_object() == unraveled_by_dict(frame.data)
+        assert json.dumps(frame.to_object()) == json.dumps(unraveled_by_dict(frame.data))
+
+    def test_float32_to_object(self):
+        # float fields are rounded to the shortest float32 representation like MessageToDict,
+        # including subnormal values which keep at least 6 significant digits
+        rng = np.random.default_rng(0)
+        values = np.concatenate([
+            [1e-45, -3e-42, 1.17549e-38, 0., -0., 3.4e38, 0.1, 1 / 3, -2.5],
+            rng.random(1000),
+            rng.standard_normal(1001) * 10. ** rng.integers(-45, 38, 1001),
+        ]).astype(np.float32)
+        for count in [6, len(values)]: # converted one by one and in batch
+            polygon = Polygon(vertices=values[:count])
+            expected = MessageToDict(polygon, preserving_proto_field_name=True)['vertices']
+            builder = xb.XVIZBuilder()
+            builder.primitive('/test_polygon').polygon(values[:count])
+            frame = builder.get_data()
+            assert frame.to_object()['primitives']['/test_polygon']['polygons'][0]['vertices'] \
+                == expected
+
+    def test_metadata_to_object(self):
+        builder = self._get_metadata_builder()
+        builder.stream('/point/lidar')\
+            .stream_style({'fill_color': [1, 2, 3], 'opacity': 0.3, 'point_color_domain': [0, 2.7]})\
+            .style_class('class', {'stroke_color': [4, 5, 6, 7], 'radius': 1.3})
+        message = builder.get_message()
+        message.data.ui_config['panel'].config.update({'list': [1, 'a', {'b': None}]})
+
+        obj = message.to_object()
+        assert obj['streams']['/point/lidar']['stream_style']['fill_color'] == [1, 2, 3]
+        assert obj['streams']['/point/lidar']['style_classes'] == [
+            {'name': 'class', 'style': {'stroke_color': [4, 5, 6, 7], 'radius': 1.3}}]
+
+        expected = MessageToDict(message.data, preserving_proto_field_name=True)
+        for sdata in expected['streams'].values():
+            if 'stream_style' in sdata:
+                _unravel_style_object(sdata['stream_style'])
+            for style_class in sdata.get('style_classes', []):
+                _unravel_style_object(style_class['style'])
+        assert obj == expected
@@ -0,0 +1,370 @@
+import asyncio
+import json
+import time
+import tempfile
+import threading
+import xviz_avs as xa
+import xviz_avs.io as xi
+import xviz_avs.builder as xb
+from easydict import EasyDict as edict
+from xviz_avs.server import XVIZServer, XVIZLogPlayHandler, XVIZPrefetcher, XVIZFrameCache, \
+    XVIZBroadcaster, XVIZBroadcastSession
+
+class _RecordingSocket:
+    def __init__(self, send_delay=0, requests=(), send_gate=None, request_delay=0):
+        '''
+        :param requests: list of (number of messages sent, request) sent by the client
+        :param send_gate: asyncio.Event that sending waits for
+        :param request_delay: time between the messages being sent and a request
+        '''
+        self.sent = []
+        self.send_times = []
+        self.closed = False
+        self._send_delay = send_delay
+        self._send_gate = send_gate
+        self._requests = list(requests)
+        self._request_delay = request_delay
+        self._sent_event = None # created in the event loop
+
+    @property
+    def _sent_changed(self):
+        if self._sent_event is None:
+            self._sent_event = asyncio.Event()
+        return self._sent_event
+
+    async def wait_sent(self, count):
+        '''
+        Wait until `count` messages are sent
+        '''
+        while len(self.sent) < count:
+            self._sent_changed.clear()
+            await self._sent_changed.wait()
+
+    async def recv(self):
+        while not self._requests:
+            await asyncio.Event().wait() # the client sends nothing more
+        count, request = self._requests[0]
+        await self.wait_sent(count)
+        if self._request_delay:
+            await asyncio.sleep(self._request_delay)
+        self._requests.pop(0)
+        return request
+
+    async def send(self, data):
+        if self._send_gate is not None:
+            await self._send_gate.wait()
+        if self._send_delay:
+            await asyncio.sleep(self._send_delay) # waiting for the buffer to drain
+        self.sent.append(data)
+        self.send_times.append(time.monotonic())
+        self._sent_changed.set()
+
+    async def close(self):
+        self.closed = True
+
+def _write_log(directory, writer_class, count=10, interval=0.02):
+    writer = writer_class(xi.DirectorySource(directory))
+    metadata = xa.XVIZMetadataBuilder()
+    metadata.stream('/vehicle_pose').category(xa.CATEGORY.POSE)
+    metadata.start_time(1.0).end_time(1.0 + (count - 1) * interval)
+    writer.write_message(metadata.get_message())
+    for i in range(count):
+        builder = xb.XVIZBuilder()
+        builder.pose().timestamp(1.0 + i * interval)
+        writer.write_message(builder.get_message())
+    writer.close()
+
+def _play(directory, socket, **params):
+    request = edict(params, path='/')
+    session = XVIZLogPlayHandler(directory, read_ahead=2)(socket, request)
+    assert session is not None
+    asyncio.run(session.main())
+    return session
+
+class TestLogPlaySession:
+    def test_play_json(self):
+        with tempfile.TemporaryDirectory() as directory:
+            _write_log(directory, xi.XVIZJsonWriter)
+            socket = _RecordingSocket()
+            _play(directory, socket)
+
+        assert len(socket.sent) == 11
+        assert json.loads(socket.sent[0])['type'] == 'xviz/metadata'
+        timestamps = [json.loads(data)['data']['updates'][0]['timestamp'] for data in socket.sent[1:]]
+        assert timestamps == [round(1.0 + i * 0.02, 10) for i in range(10)]
+
+        # paced by the timestamps
+        assert socket.send_times[-1] - socket.send_times[1] >= 0.9 * 9 * 0.02
+
+    def test_play_time_range(self):
+        with tempfile.TemporaryDirectory() as directory:
+            _write_log(directory, xi.XVIZGLBWriter)
+            socket = _RecordingSocket()
+            _play(directory, socket, start_time='1.05', duration='0.1')
+
+            reader = xi.XVIZGLBReader(xi.DirectorySource(directory))
+            expected = [reader.read_message_data(i) for i in range(3, 8)]
+
+        assert isinstance(socket.sent[0], bytes)
+        assert socket.sent[1:] == expected
+
+    def test_play_backpressure(self):
+        with tempfile.TemporaryDirectory() as directory:
+            _write_log(directory, xi.XVIZProtobufWriter, interval=0)
+            socket = _RecordingSocket(send_delay=0.01)
+            session = XVIZLogPlayHandler(directory, read_ahead=2)(socket, edict(path='/'))
+
+            reads = []
+            read = session._provider.xviz_message_data
+            def tracked_read(position):
+                reads.append(len(socket.sent))
+                return read(position)
+            session._provider.xviz_message_data = tracked_read
+            asyncio.run(session.main())
+
+        assert len(socket.sent) == 11
+        # messages are not read further than read_ahead + the one being sent
+        assert all(position - sent <= 4 for position, sent in enumerate(reads))
+
+    def test_play_seek(self):
+        seek = json.dumps({'type': 'xviz/transform_log', 'data': {'start_timestamp': 1.0}})
+        with tempfile.TemporaryDirectory() as directory:
+            _write_log(directory, xi.XVIZJsonWriter, interval=0.01)
+            socket = _RecordingSocket(requests=[(1, 'invalid'), (6, seek)])
+            _play(directory, socket, duration='0.095')
+
+        timestamps = [json.loads(data)['data']['updates'][0]['timestamp'] for data in socket.sent[1:]]
+        # restarted after 5 messages, the messages queued before seeking are dropped
+        assert timestamps == [round(1.0 + i * 0.01, 10) for i in list(range(5)) + list(range(10))]
+
+    def test_play_seek_while_waiting(self):
+        seek = json.dumps({'type': 'xviz/transform_log',
+                           'data': {'start_timestamp': 1.0, 'end_timestamp': 1.0}})
+        with tempfile.TemporaryDirectory() as directory:
+            _write_log(directory, xi.XVIZJsonWriter, count=3, interval=10)
+            socket = _RecordingSocket(requests=[(2, seek)], request_delay=0.2)
+            start = time.monotonic()
+            _play(directory, socket)
+
+        # the seek interrupts the wait for the second message
+        assert time.monotonic() - start < 5
+        timestamps = [json.loads(data)['data']['updates'][0]['timestamp'] for data in socket.sent[1:]]
+        assert timestamps == [1.0, 1.0]
+
+    def test_invalid_request(self):
+        with tempfile.TemporaryDirectory() as directory:
+            _write_log(directory, xi.XVIZJsonWriter, count=1)
+            assert XVIZLogPlayHandler(directory)(_RecordingSocket(), edict(path='/../')) is None
+
+            socket = _RecordingSocket()
+            _play(directory, socket, start_time='abc')
+            assert socket.closed and not socket.sent
+
+async def _loaded(prefetcher):
+    # wait for the messages being loaded in the window
+    await asyncio.wait([future for _, future in prefetcher._window])
+
+class TestPrefetcher:
+    def test_window(self):
+        loads = []
+        def load(position):
+            loads.append(position)
+            return b'x' * 10
+
+        async def run():
+            prefetcher = XVIZPrefetcher(load, max_messages=4, max_bytes=25)
+            prefetcher.seek(range(10))
+            assert prefetcher.window_size == 4
+            await _loaded(prefetcher)
+            assert prefetcher.loaded_bytes == 40
+
+            # bounded by bytes after the loaded messages are known
+            assert await prefetcher.next() == (0, b'x' * 10)
+            assert prefetcher.window_size == 3
+            assert await prefetcher.next() == (1, b'x' * 10)
+            assert prefetcher.window_size == 3
+
+            await _loaded(prefetcher)
+            assert prefetcher.loaded_bytes == 30
+            prefetcher.seek([7, 8])
+            assert prefetcher.loaded_bytes == 0
+            assert [await prefetcher.next(), await prefetcher.next()] == [(7, b'x' * 10), (8, b'x' * 10)]
+            assert await prefetcher.next() is None
+            prefetcher.close()
+
+        asyncio.run(run())
+        assert 9 not in loads
+
+    def test_seek_while_loading(self):
+        release = threading.Event()
+        def load(position):
+            if position == 0:
+                release.wait()
+            return b'%d' % position
+
+        async def run():
+            prefetcher = XVIZPrefetcher(load, max_messages=2)
+            prefetcher.seek(range(3))
+            waiting = asyncio.ensure_future(prefetcher.next())
+            await asyncio.sleep(0) # next() waits for message 0
+            prefetcher.seek([5])
+            release.set()
+            result = await waiting
+            prefetcher.close()
+            return result
+
+        assert asyncio.run(run()) == (5, b'5')
+
+    def test_error(self):
+        def load(position):
+            raise IOError("cannot read %d" % position)
+
+        async def run():
+            prefetcher = XVIZPrefetcher(load)
+            prefetcher.seek(range(3))
+            try:
+                await prefetcher.next()
+            except IOError as e:
+                return str(e)
+            finally:
+                prefetcher.close()
+
+        assert asyncio.run(run()) == "cannot read 0"
+
+class TestFrameCache:
+    def test_lru(self):
+        cache = XVIZFrameCache(max_bytes=25)
+        assert cache.get(('log', 0, 'json'), lambda: 'a' * 10) == 'a' * 10
+        assert cache.get(('log', 1, 'json'), lambda: 'b' * 10) == 'b' * 10
+        assert cache.get(('log', 0, 'json'), lambda: 'x') == 'a' * 10 # touched
+        cache.get(('log', 2, 'json'), lambda: 'c' * 10) # evicts frame 1
+        cache.get(('log', 3, 'json'), lambda: 'd' * 30) # too large to be cached
+        assert cache.get(('log', 1, 'json'), lambda: 'e') == 'e'
+
+        stats = cache.stats
+        assert (stats['hits'], stats['misses'], stats['evictions']) == (1, 5, 1)
+        assert stats['bytes'] <= 25
+
+    def test_text_size(self):
+        cache = XVIZFrameCache(max_bytes=25)
+        cache.get(('log', 0, 'json'), lambda: '\u00e9' * 10) # 20 bytes in UTF-8
+        assert cache.stats['bytes'] == 20
+        cache.get(('log', 1, 'json'), lambda: 'a' * 10)
+        assert cache.stats['evictions'] == 1 and cache.stats['bytes'] == 10
+
+    def test_coalesced(self):
+        cache = XVIZFrameCache()
+        started, release = threading.Event(), threading.Event()
+        loads = []
+        def load():
+            loads.append(1)
+            started.set()
+            release.wait()
+            return b'frame'
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get(('log', 0, 'glb'), load)))
+                   for _ in range(4)]
+        threads[0].start()
+        started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        while cache.stats['coalesced'] < 3:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        assert len(loads) == 1
+        assert results == [b'frame'] * 4
+
+    def test_load_error(self):
+        cache = XVIZFrameCache()
+        def load():
+            raise IOError("missing")
+        try:
+            cache.get(('log', 0, 'glb'), load)
+        except IOError:
+            pass
+        assert cache.get(('log', 0, 'glb'), lambda: b'frame') == b'frame'
+
+    def test_shared_by_sessions(self):
+        with tempfile.TemporaryDirectory() as directory:
+            _write_log(directory, xi.XVIZGLBWriter, interval=0)
+            handler = XVIZLogPlayHandler(directory)
+            server = XVIZServer(handler)
+
+            async def play_all():
+                sockets = [_RecordingSocket() for _ in range(3)]
+                sessions = [handler(socket, edict(path='/')) for socket in sockets]
+                await asyncio.gather(*[session.main() for session in sessions])
+                return sockets
+            sockets = asyncio.run(play_all())
+
+        assert sockets[0].sent == sockets[1].sent == sockets[2].sent
+        stats = server.frame_cache.stats
+        assert stats['misses'] == 11
+        assert stats['hits'] + stats['coalesced'] == 22
+
+class TestBroadcast:
+    def test_fan_out(self):
+        encoded = []
+        async def run():
+            release_slow = asyncio.Event()
+            fast, fast2 = _RecordingSocket(), _RecordingSocket()
+            slow = _RecordingSocket(send_gate=release_slow)
+
+            async def produce():
+                for i in range(20):
+                    encoded.append(i)
+                    yield json.dumps({'frame': i})
+                    # metadata and the frames up to i are sent by the fast clients
+                    await fast.wait_sent(i + 2)
+                    await fast2.wait_sent(i + 2)
+                # the slow client is still sending the metadata
+                assert slow.sent == []
+                release_slow.set()
+
+            broadcaster = XVIZBroadcaster(produce, metadata='metadata', max_queue_size=3)
+            sessions = [XVIZBroadcastSession(socket, None, broadcaster)
+                        for socket in (fast, fast2, slow)]
+            await asyncio.gather(*[session.main() for session in sessions])
+            assert broadcaster.subscriber_count == 0
+            return fast, fast2, slow
+        fast, fast2, slow = asyncio.run(run())
+
+        # every frame is encoded once and the same object is sent to all clients
+        assert encoded == list(range(20))
+        assert fast.sent[0] == 'metadata'
+        assert [json.loads(data)['frame'] for data in fast.sent[1:]] == list(range(20))
+        assert all(a is b for a, b in zip(fast.sent, fast2.sent))
+
+        # the slow client skips old frames but still gets the latest ones
+        assert slow.sent[0] == 'metadata'
+        assert [json.loads(data)['frame'] for data in slow.sent[1:]] == [17, 18, 19]
+
+    def test_stop_without_subscribers(self):
+        async def produce():
+            while True:
+                yield 'frame'
+                await asyncio.sleep(0)
+
+        async def run():
+            broadcaster = XVIZBroadcaster(produce)
+            socket = _RecordingSocket()
+            session = XVIZBroadcastSession(socket, None, broadcaster)
+            task = asyncio.ensure_future(session.main())
+            await socket.wait_sent(3)
+            assert broadcaster.subscriber_count == 1
+            producer = broadcaster._task
+
+            task.cancel()
+            await asyncio.gather(task, producer, return_exceptions=True)
+            assert broadcaster.subscriber_count == 0
+            assert producer.cancelled()
+            count = broadcaster.frame_count
+            for _ in range(10):
+                await asyncio.sleep(0)
+            assert broadcaster.frame_count == count
+
+        asyncio.run(run())
@@ -11,7 +11,9 @@ from .base_builder import XVIZBaseBuilder,\
     COORDINATE_TYPES,\
     SCALAR_TYPE,\
     PRIMITIVE_TYPES,\
-    UIPRIMITIVE_TYPES
+    UIPRIMITIVE_TYPES,\
+    VALIDATION_MODES,\
+    compile_metadata
 from .xviz_builder import XVIZBuilder
 from .xviz_ui_builder import XVIZUIBuilder
 
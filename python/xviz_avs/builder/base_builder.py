@@ -1,4 +1,6 @@
 import logging
+import threading
+from collections import namedtuple, OrderedDict
 from typing import Union
 from easydict import EasyDict as edict
 
@@ -78,6 +80,35 @@ for fields in PRIMITIVE_STYLE_MAP.values():
     for f in fields:
         assert f in StyleStreamValueFields
 
+# 'full' checks the metadata on every flush, 'compiled' checks against the table
+# built by `compile_metadata`, 'strict' is 'compiled' plus the check of primitive
+# style properties and 'none' skips the validation
+VALIDATION_MODES = ('full', 'compiled', 'strict', 'none')
+
+stream_validation_t = namedtuple("streamValidationItem", ("category", "primitive_type", "style_fields"))
+
+def compile_metadata(metadata: Union[Metadata, XVIZMessage]) -> dict:
+    '''
+    Compile the stream definitions in metadata into a dict keyed by stream id, so that
+    validating a stream is a single lookup
+
+    :return: dict of stream_id -> stream_validation_t
+    '''
+    if isinstance(metadata, XVIZMessage):
+        metadata = metadata.readonly_data
+    if not metadata:
+        return {}
+
+    table = {}
+    for stream_id, stream in metadata.streams.items():
+        style_fields = PRIMITIVE_STYLE_MAP.get(stream.primitive_type)
+        table[stream_id] = stream_validation_t(
+            category=stream.category,
+            primitive_type=stream.primitive_type,
+            style_fields=frozenset(style_fields) if style_fields else None
+        )
+    return table
+
 class XVIZBaseBuilder:
     """
     # Reference
@@ -86,8 +117,28 @@ class XVIZBaseBuilder:
     def __init__(self, category, metadata: Union[Metadata, XVIZMessage], logger=None):
         self._stream_id = None
         self._category = category
-        self._metadata = metadata.data if isinstance(metadata, XVIZMessage) else metadata
+        self._metadata = metadata.readonly_data if isinstance(metadata, XVIZMessage) else metadata
         self._logger = logger or logging.getLogger("xviz")
+        self._validation = 'full'
+        self._stream_table = None
+
+    def set_validation(self, mode='full', stream_table=None):
+        '''
+        Set how streams are validated against metadata when flushed
+
+        :param mode: one of VALIDATION_MODES
+        :param stream_table: table built by `compile_metadata`, compiled from
+            the builder metadata if not provided in 'compiled' or 'strict' mode
+        '''
+        if mode not in VALIDATION_MODES:
+            raise ValueError("Unknown validation mode '%s', expecting one of %s" % (mode, VALIDATION_MODES))
+        compiled = mode in ('compiled', 'strict')
+        if compiled and stream_table is None:
+            stream_table = compile_metadata(self._metadata)
+
+        self._validation = mode
+        self._stream_table = stream_table if compiled else None
+        return self
 
     def stream(self, stream_id):
         if self._stream_id:
@@ -111,6 +162,12 @@ class XVIZBaseBuilder:
     def reset(self):
         self._stream_id = None
 
+    def clear(self):
+        '''
+        Drop all the data added to this builder so that it can be reused for the next frame
+        '''
+        self.reset()
+
     def _validate_has_prop(self, name):
         if not hasattr(self, name) or (getattr(self, name) == None):
             self._logger.warning("Stream %s: %s is missing", self.stream_id, name)
@@ -142,7 +199,26 @@ class XVIZBaseBuilder:
                     CATEGORY.Name(metastream.category)
                 )
 
+    def _validate_compiled_metadata(self):
+        entry = self._stream_table.get(self._stream_id)
+        if entry is None:
+            if not self._metadata:
+                self._logger.warning("Metadata is missing.")
+            else:
+                self._logger.warning("%s is not defined in metadata.", self._stream_id)
+        elif self._category != entry.category:
+            self._logger.warning(
+                "Stream %s category '%s' does not match metadata definition (%s).",
+                self._stream_id,
+                CATEGORY.Name(self._category),
+                CATEGORY.Name(entry.category)
+            )
+
     def _validate(self):
+        if self._stream_table is not None:
+            self._validate_compiled_metadata()
+            return
+
         self._validate_has_prop('_stream_id')
         self._validate_has_prop('_category')
         self._validate_match_metadata()
@@ -150,22 +226,77 @@ class XVIZBaseBuilder:
 import array
 from xviz_avs.v2.style_pb2 import StyleObjectValue, StyleStreamValue
 
+# Maximum number of distinct styles kept by build_object_style and build_stream_style
+STYLE_CACHE_SIZE = 256
+
+# Built styles keyed by style content. Since styles are usually reused as the same
+# dict objects, they are also looked up by identity and compared with a snapshot.
+# Both caches are LRU ordered and shared by the builders of all threads.
+_style_content_cache = OrderedDict()
+_style_identity_cache = OrderedDict()
+_style_cache_lock = threading.Lock()
+
+def _style_fields(style):
+    fields = dict(style)
+    if 'fill_color' in fields:
+        fields['fill_color'] = bytes(fields['fill_color'])
+    if 'stroke_color' in fields:
+        fields['stroke_color'] = bytes(fields['stroke_color'])
+    return fields
+
+def _cache_put(cache, key, value):
+    cache[key] = value
+    cache.move_to_end(key)
+    if len(cache) > STYLE_CACHE_SIZE:
+        cache.popitem(last=False)
+
+def _build_style(style_class, style):
+    identity_key = (style_class, id(style))
+    with _style_cache_lock:
+        entry = _style_identity_cache.get(identity_key)
+        if entry is not None:
+            _style_identity_cache.move_to_end(identity_key)
+    if entry is not None:
+        try:
+            if entry[0] == style:
+                return entry[1]
+        except ValueError: # compared with numpy array
+            pass
+
+    content_key = (style_class,) + tuple([(k, tuple(v) if isinstance(v, list) else v)
+                                          for k, v in style.items()])
+    try:
+        hash(content_key)
+    except TypeError: # unhashable values like numpy arrays are not cached
+        return style_class(**_style_fields(style))
+
+    with _style_cache_lock:
+        message = _style_content_cache.get(content_key)
+        if message is not None:
+            _style_content_cache.move_to_end(content_key)
+    if message is None:
+        message = style_class(**_style_fields(style))
+
+    snapshot = {k: list(v) if isinstance(v, list) else v for k, v in style.items()}
+    with _style_cache_lock:
+        # another thread may have built the same style meanwhile, keep the cached one
+        message = _style_content_cache.setdefault(content_key, message)
+        _cache_put(_style_content_cache, content_key, message)
+        _cache_put(_style_identity_cache, identity_key, (snapshot, message))
+    return message
+
 def build_object_style(style):
     '''
     Create StyleObjectValue from dictionary. It basically deal with list of bytes.
+    The result is cached by style content and shared between calls, so it should be
+    copied (e.g. by MergeFrom) instead of being modified. The input is not modified.
     '''
-    if 'fill_color' in style.keys():
-        style['fill_color'] = bytes(style['fill_color'])
-    if 'stroke_color' in style.keys():
-        style['stroke_color'] = bytes(style['stroke_color'])
-    return StyleObjectValue(**style)
+    return _build_style(StyleObjectValue, style)
 
 def build_stream_style(style):
     '''
     Create StyleStreamValue from dictionary. It basically deal with list of bytes.
+    The result is cached by style content and shared between calls, so it should be
+    copied (e.g. by MergeFrom) instead of being modified. The input is not modified.
     '''
-    if 'fill_color' in style.keys():
-        style['fill_color'] = bytes(style['fill_color'])
-    if 'stroke_color' in style.keys():
-        style['stroke_color'] = bytes(style['stroke_color'])
-    return StyleStreamValue(**style)
+    return _build_style(StyleStreamValue, style)
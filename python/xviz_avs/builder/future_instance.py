@@ -1,5 +1,7 @@
+import numpy as np
+
 from xviz_avs.builder.base_builder import CATEGORY, PRIMITIVE_TYPES
-from xviz_avs.builder.primitive import XVIZPrimitiveBuilder
+from xviz_avs.builder.primitive import XVIZPrimitiveBuilder, _append_primitives
 from xviz_avs.v2.core_pb2 import FutureInstances, PrimitiveState
 
 
@@ -11,18 +13,63 @@ class XVIZFutureInstanceBuilder(XVIZPrimitiveBuilder):
         self.reset()
         self._futures = {}
 
-        # Store entries in this list as (timestamp, type, primitive)
-        # which we convert to Protobuf messages upon get_data()
+        # Store primitives by stream then timestamp, which are
+        # converted to FutureInstances in timestamp order upon get_data()
         self._futures_list = {}
 
     def reset(self):
         super().reset()
         self._ts = None
 
+    def clear(self):
+        super().clear()
+        self._futures = {}
+        self._futures_list = {}
+
     def timestamp(self, timestamp):
         self._ts = timestamp
         return self
 
+    def trajectories(self, timestamps, positions, ids=None, classes=None, styles=None):
+        '''
+        Add the predicted trajectories of many objects at once
+
+        :param timestamps: future timestamps, in shape (T,)
+        :param positions: numpy array in shape (T, N, 3) for N objects added as points, or
+            in shape (T, N, V, 3) for N objects added as polygons of V vertices
+        :param ids: object id of each of the N objects
+        :param classes: list of classes of each of the N objects
+        :param styles: a style dict shared by all objects, or one style dict per object
+        '''
+        if self._type:
+            stream_id = self._stream_id
+            self._flush()
+            self._stream_id = stream_id
+
+        timestamps = np.asarray(timestamps, dtype=np.float64).reshape(-1).tolist()
+        positions = np.asarray(positions, dtype=np.float32)
+        if positions.ndim not in (3, 4) or positions.shape[-1] != 3 or len(positions) != len(timestamps):
+            self._logger.error("Positions must be in shape (T, N, 3) or (T, N, V, 3) with T = {} where {} "
+                               "was provided".format(len(timestamps), positions.shape))
+            return self
+        if not self._validate_batch_lengths(positions.shape[1], ids, classes, styles):
+            return self
+
+        if positions.ndim == 3:
+            field_name, vertex_field = 'points', 'points'
+            self._validate_batch_styles(PRIMITIVE_TYPES.POINT, styles)
+        else:
+            field_name, vertex_field = 'polygons', 'vertices'
+            self._validate_batch_styles(PRIMITIVE_TYPES.POLYGON, styles)
+
+        # Convert the whole tensor at once and fill one timestamp at a time
+        vertex_lists = positions.reshape(positions.shape[0], positions.shape[1], -1).tolist()
+        for timestamp, vertex_list in zip(timestamps, vertex_lists):
+            primitives = getattr(self._get_future_primitives(timestamp), field_name)
+            _append_primitives(primitives, vertex_field, vertex_list, ids, classes, styles)
+
+        return self
+
     def _get_primitives_type(self, primitives, primitive_type):
         if primitive_type == PRIMITIVE_TYPES.CIRCLE:
             return primitives.circles
@@ -41,39 +88,31 @@ class XVIZFutureInstanceBuilder(XVIZPrimitiveBuilder):
         else:
             raise ValueError("FutureInstance type '{0}' is not recognized".format(primitive_type))
 
+    def _get_future_primitives(self, timestamp):
+        stream_futures = self._futures_list.get(self._stream_id)
+        if stream_futures is None:
+            stream_futures = self._futures_list[self._stream_id] = {}
+
+        primitives = stream_futures.get(timestamp)
+        if primitives is None:
+            primitives = stream_futures[timestamp] = PrimitiveState()
+        return primitives
+
     def _flush_futures_list(self):
         # Since you cannot insert into a repeated message field
-        # we construct the protobuf message in order
-        for stream, entries in self._futures_list.items():
-            if stream not in self._futures:
-                self._futures[stream] = FutureInstances()
-
-                futures = self._futures[stream]
-
-                # sort on timestamp
-                entries.sort(key=lambda e: e[0])
-                last_ts = None
-
-                for entry in entries:
-                    if last_ts is None or entry[0] != last_ts:
-                        # Adding a new timestamp entry to the arrays
-                        last_ts = entry[0]
-                        futures.timestamps.append(entry[0])
-                        future_prim = futures.primitives.add()
-                        future_prim_type = self._get_primitives_type(future_prim, entry[1])
-                        future_prim_type.append(entry[2])
-                    else:
-                        index = len(futures.timestamps)-1
-                        future_prim = futures.primitives[index]
-                        future_prim_type = self._get_primitives_type(future_prim, entry[1])
-                        future_prim_type.append(entry[2])
+        # we construct the protobuf message in order of timestamps
+        for stream, stream_futures in self._futures_list.items():
+            timestamps = sorted(stream_futures)
+            self._futures[stream] = FutureInstances(
+                timestamps=timestamps,
+                primitives=[stream_futures[ts] for ts in timestamps]
+            )
 
     def _flush(self):
-        if self._stream_id not in self._futures_list:
-            self._futures_list[self._stream_id] = []
-
+        if not self._type: # nothing pending, e.g. after trajectories
+            return
         primitive = self._format_primitive()
-        self._futures_list[self._stream_id].append((self._ts, self._type, primitive))
+        self._get_primitives_type(self._get_future_primitives(self._ts), self._type).append(primitive)
 
         self.reset()
 
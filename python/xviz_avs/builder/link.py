@@ -22,6 +22,11 @@ class XVIZLinkBuilder(XVIZBaseBuilder):
     def reset(self):
         super().reset()
 
+    def clear(self):
+        super().clear()
+        self._links = None
+        self._target_stream = None
+
     def get_data(self):
         if self._stream_id:
             self._flush()
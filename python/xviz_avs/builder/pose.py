@@ -18,6 +18,10 @@ class XVIZPoseBuilder(XVIZBaseBuilder):
         self._category = CATEGORY.POSE
         self._temp_pose = Pose()
 
+    def clear(self):
+        super().clear()
+        self._poses = None
+
     def map_origin(self, longitude, latitude, altitude):
         self._temp_pose.map_origin.longitude = longitude
         self._temp_pose.map_origin.latitude = latitude
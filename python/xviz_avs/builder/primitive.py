@@ -2,7 +2,48 @@ import numpy as np
 
 from xviz_avs.builder.base_builder import XVIZBaseBuilder, build_object_style, CATEGORY, PRIMITIVE_TYPES, PRIMITIVE_STYLE_MAP
 from xviz_avs.v2.core_pb2 import PrimitiveState
-from xviz_avs.v2.primitives_pb2 import PrimitiveBase, Circle, Image, Point, Polygon, Polyline, Stadium, Text
+from xviz_avs.v2.primitives_pb2 import Circle, Image, Point, Polygon, Polyline, Stadium, Text
+
+# Attribute lookups on protobuf enums are slow, cache the ones used in validation
+_PRIMITIVE_IMAGE = PRIMITIVE_TYPES.IMAGE
+_PRIMITIVE_POINT = PRIMITIVE_TYPES.POINT
+
+def _set_float_array(message, field_name, values):
+    '''
+    Fill a repeated float field. Numpy arrays are converted to a list at once,
+    extending the field from the array elements is much slower.
+    '''
+    if isinstance(values, np.ndarray):
+        values = values.reshape(-1).tolist()
+    getattr(message, field_name).extend(values)
+
+def _append_primitives(array, vertex_field, vertex_list, ids=None, classes=None, styles=None):
+    '''
+    Append one primitive per vertex list to the repeated primitive field `array`
+
+    :param vertex_list: flat vertex lists or float32 numpy arrays, one per primitive
+
+    :param styles: a style dict shared by all primitives, or one style dict per primitive
+    '''
+    shared_style = build_object_style(styles) if isinstance(styles, dict) else None
+    has_base = ids is not None or classes is not None or styles is not None
+
+    for i, vertices in enumerate(vertex_list):
+        obj = array.add()
+        _set_float_array(obj, vertex_field, vertices)
+        if not has_base:
+            continue
+
+        base = obj.base
+        if ids is not None:
+            # numpy ids are converted, e.g. int64 or numpy strings
+            base.object_id = str(ids[i])
+        if classes is not None and classes[i] is not None and len(classes[i]):
+            base.classes.extend(str(name) for name in classes[i])
+        if shared_style is not None:
+            base.style.CopyFrom(shared_style)
+        elif styles is not None and styles[i]:
+            base.style.CopyFrom(build_object_style(styles[i]))
 
 
 class XVIZPrimitiveBuilder(XVIZBaseBuilder):
@@ -52,6 +93,7 @@ class XVIZPrimitiveBuilder(XVIZBaseBuilder):
             self._flush()
 
         self._validate_prop_set_once("_vertices")
+        self._validate_vertices(vertices)
         self._vertices = vertices
         self._type = PRIMITIVE_TYPES.POLYGON
 
@@ -62,21 +104,40 @@ class XVIZPrimitiveBuilder(XVIZBaseBuilder):
             self._flush()
 
         self._validate_prop_set_once("_vertices")
+        self._validate_vertices(vertices)
         self._vertices = vertices
         self._type = PRIMITIVE_TYPES.POLYLINE
 
         return self
 
     def points(self, vertices):
+        '''
+        Add a point cloud
+
+        :param vertices: flat list [x0, y0, z0, x1, ...], or numpy array in shape (N, 3) or (3N,)
+        '''
         if self._type:
             self._flush()
 
         self._validate_prop_set_once("_vertices")
+        self._validate_vertices(vertices)
         self._vertices = vertices
         self._type = PRIMITIVE_TYPES.POINT
 
         return self
 
+    def polygons(self, vertices, offsets=None, ids=None, classes=None, styles=None):
+        '''
+        Add a batch of polygons to the stream in one pass. See `_add_batch` for parameters.
+        '''
+        return self._add_batch(PRIMITIVE_TYPES.POLYGON, vertices, offsets, ids, classes, styles)
+
+    def polylines(self, vertices, offsets=None, ids=None, classes=None, styles=None):
+        '''
+        Add a batch of polylines to the stream in one pass. See `_add_batch` for parameters.
+        '''
+        return self._add_batch(PRIMITIVE_TYPES.POLYLINE, vertices, offsets, ids, classes, styles)
+
     def circle(self, position, radius):
         if self._type:
             self._flush()
@@ -128,7 +189,23 @@ class XVIZPrimitiveBuilder(XVIZBaseBuilder):
         return self
 
     def colors(self, color_array):
+        '''
+        Add colors of the points
+
+        :param color_array: flat list of RGB or RGBA values, or uint8 numpy array in shape (N, 3) or (N, 4)
+        '''
         self._validate_prop_set_once('_colors')
+        if isinstance(color_array, np.ndarray) and \
+           not (color_array.ndim == 1 or (color_array.ndim == 2 and color_array.shape[1] in (3, 4))):
+            self._logger.error("Colors must be in shape (N, 3) or (N, 4) where {} was provided"
+                               .format(color_array.shape))
+        if isinstance(color_array, np.ndarray) and color_array.dtype != np.uint8:
+            if color_array.dtype.kind not in 'iu' or \
+               (color_array.size and (color_array.min() < 0 or color_array.max() > 255)):
+                self._logger.error("Colors must be integers in range [0, 255], the {} array is ignored"
+                                   .format(color_array.dtype))
+                return self
+            color_array = color_array.astype(np.uint8)
         self._colors = color_array
 
         return self
@@ -157,15 +234,33 @@ class XVIZPrimitiveBuilder(XVIZBaseBuilder):
     def _validate(self):
         super()._validate()
 
-        if self._type == PRIMITIVE_TYPES.IMAGE:
+        if self._type == _PRIMITIVE_IMAGE:
             if self._image is None or self._image.data is None:
                 self._logger.warning("Stream {} image data are not provided.".format(self._stream_id))
         else:
             if self._vertices is None:
                 self._logger.warning("Stream {} primitives vertices are not provided.".format(self._stream_id))
 
+        if self._style and self._validation == 'strict':
+            self._validate_style(self._style, self._type)
+
+        if self._type == _PRIMITIVE_POINT and isinstance(self._vertices, np.ndarray) \
+           and isinstance(self._colors, np.ndarray) and self._colors.ndim == 2 \
+           and self._colors.shape[0] != self._vertices.size // 3:
+            self._logger.error("Stream {} has {} colors for {} points".format(
+                self._stream_id, self._colors.shape[0], self._vertices.size // 3))
+
+    def _validate_vertices(self, vertices):
+        if isinstance(vertices, np.ndarray) and \
+           not (vertices.ndim == 2 and vertices.shape[1] == 3 or vertices.ndim == 1 and vertices.size % 3 == 0):
+            self._logger.error("Vertices must be in shape (N, 3) or (3N,) where {} was provided"
+                               .format(vertices.shape))
+
     def _flush(self):
-        self._validate()
+        if not self._type: # nothing pending, e.g. after a batch
+            return
+        if self._validation != 'none':
+            self._validate()
         self._flush_primitives()
 
     def get_data(self):
@@ -177,6 +272,71 @@ class XVIZPrimitiveBuilder(XVIZBaseBuilder):
 
         return self._primitives
 
+    def _add_batch(self, primitive_type, vertices, offsets=None, ids=None, classes=None, styles=None):
+        '''
+        Append a batch of vertex based primitives to the current stream
+
+        :param vertices: numpy array in shape (count, N, 3) or list of flat vertex lists,
+            one per primitive. With `offsets`, all the vertices in shape (M, 3) or (3M,)
+        :param offsets: vertex index where each primitive starts, with length count + 1
+        :param ids: object id of each primitive
+        :param classes: list of classes of each primitive
+        :param styles: a style dict shared by all primitives, or one style dict per primitive
+        '''
+        if self._type:
+            # flushing the pending primitive resets the builder, the batch goes to the same stream
+            stream_id = self._stream_id
+            self._flush()
+            self._stream_id = stream_id
+
+        # Convert the whole batch to float32 once, each primitive is then a view of it
+        if offsets is not None:
+            flat = np.asarray(vertices, dtype=np.float32).reshape(-1)
+            offsets = [int(offset) * 3 for offset in offsets]
+            vertex_list = [flat[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+        elif isinstance(vertices, np.ndarray):
+            if vertices.ndim != 3 or vertices.shape[2] != 3:
+                self._logger.error("Vertices must be in shape (count, N, 3) where {} was provided"
+                                   .format(vertices.shape))
+                return self
+            vertex_list = np.asarray(vertices, dtype=np.float32).reshape(len(vertices), -1)
+        else:
+            vertex_list = vertices
+
+        if not self._validate_batch_lengths(len(vertex_list), ids, classes, styles):
+            return self
+
+        if self._stream_table is not None:
+            self._validate_compiled_metadata()
+        elif self._validation != 'none':
+            self._validate_match_metadata()
+        self._validate_batch_styles(primitive_type, styles)
+
+        if self._stream_id not in self._primitives:
+            self._primitives[self._stream_id] = PrimitiveState()
+        stream = self._primitives[self._stream_id]
+        array = getattr(stream, PRIMITIVE_TYPES.Name(primitive_type).lower() + 's')
+        _append_primitives(array, 'vertices', vertex_list, ids, classes, styles)
+
+        return self
+
+    def _validate_batch_lengths(self, count, ids, classes, styles):
+        if isinstance(styles, dict):
+            styles = None
+        for name, values in (('ids', ids), ('classes', classes), ('styles', styles)):
+            if values is not None and len(values) != count:
+                self._logger.error("Stream {}: {} {} provided for {} primitives"
+                                   .format(self._stream_id, len(values), name, count))
+                return False
+        return True
+
+    def _validate_batch_styles(self, primitive_type, styles):
+        if not styles or self._validation != 'strict':
+            return
+        for style in ([styles] if isinstance(styles, dict) else styles):
+            if style:
+                self._validate_style(style, primitive_type)
+
     def _validate_prerequisite(self):
         if not self._type:
             self._logger.error("Start from a primitive first, e.g polygon(), image(), etc.")
@@ -200,12 +360,17 @@ class XVIZPrimitiveBuilder(XVIZBaseBuilder):
 
         # Embed primitive data
         if self._type == PRIMITIVE_TYPES.POLYGON:
-            obj = Polygon(vertices=self._vertices)
+            obj = Polygon()
+            _set_float_array(obj, 'vertices', self._vertices)
         elif self._type == PRIMITIVE_TYPES.POLYLINE:
-            obj = Polyline(vertices=self._vertices)
+            obj = Polyline()
+            _set_float_array(obj, 'vertices', self._vertices)
         elif self._type == PRIMITIVE_TYPES.POINT:
-            obj = Point(points=self._vertices)
-            if self._colors:
+            obj = Point()
+            _set_float_array(obj, 'points', self._vertices)
+            if isinstance(self._colors, np.ndarray):
+                obj.colors = self._colors.tobytes()
+            elif self._colors:
                 obj.colors = bytes(self._colors)
         elif self._type == PRIMITIVE_TYPES.TEXT:
             obj = Text(position=self._vertices[0], text=self._text)
@@ -219,33 +384,32 @@ class XVIZPrimitiveBuilder(XVIZBaseBuilder):
             obj = self._image
 
         # Embed base data
-        have_base = False
-        base = PrimitiveBase()
-
         if self._id:
-            have_base = True
-            base.object_id = self._id
+            obj.base.object_id = self._id
         if self._style:
-            have_base = True
-            base.style.MergeFrom(build_object_style(self._style))
+            obj.base.style.CopyFrom(build_object_style(self._style))
         if self._classes:
-            have_base = True
-            base.classes.extend(self._classes)
-
-        if have_base:
-            obj.base.MergeFrom(base)
+            obj.base.classes.extend(self._classes)
 
         return obj
 
-    def _validate_style(self):
-        properties = self._style.keys()
-        valid_props = PRIMITIVE_STYLE_MAP.get(self._type)
+    def _validate_style(self, style, primitive_type):
+        properties = style.keys()
+        entry = self._stream_table.get(self._stream_id) if self._stream_table is not None else None
+        if entry is not None and entry.primitive_type == primitive_type:
+            valid_props = entry.style_fields
+        else:
+            valid_props = PRIMITIVE_STYLE_MAP.get(primitive_type)
         if valid_props:
             invalid_props = [prop for prop in properties if prop not in valid_props]
             if len(invalid_props) > 0:
                 self._logger.warning("Invalid style properties %s for stream %s",
                                      ', '.join(invalid_props), self.stream_id)
 
+    def clear(self):
+        super().clear()
+        self._primitives = {}
+
     def reset(self):
         super().reset()
         self._type = None
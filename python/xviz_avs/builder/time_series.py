@@ -1,11 +1,22 @@
+import numpy as np
+
 from xviz_avs.builder.base_builder import XVIZBaseBuilder, CATEGORY
 from xviz_avs.v2.core_pb2 import TimeSeriesState
 
+# Value field of each numpy dtype kind
+_FIELD_NAMES = {
+    'U': 'strings',
+    'b': 'bools',
+    'i': 'int32s',
+    'u': 'int32s',
+    'f': 'doubles',
+}
+
 class XVIZTimeSeriesBuilder(XVIZBaseBuilder):
     def __init__(self, metadata, logger=None):
         super().__init__(CATEGORY.TIME_SERIES, metadata, logger)
 
-        # Stores time_series data by timestamp then id
+        # Stores time_series data by timestamp then id then value type
         # They will then be group when constructing final object
         self._data = {}
         self.reset()
@@ -33,6 +44,67 @@ class XVIZTimeSeriesBuilder(XVIZBaseBuilder):
         self._timestamp = timestamp
         return self
 
+    def columns(self, streams, timestamps, values, ids=None):
+        '''
+        Add many time series values at once from parallel arrays. Entries are grouped
+        by timestamp, object id and value type, in the same order as adding them one at a time.
+
+        :param streams: stream id of each value
+        :param timestamps: timestamp of each value, or a single timestamp for all values
+        :param values: list or numpy array of values
+        :param ids: object id of each value, or None
+        '''
+        if self._data_pending():
+            self._flush()
+
+        streams = np.asarray(streams)
+        if not isinstance(values, np.ndarray):
+            # numpy would convert mixed values into strings
+            same_type = len(set(map(type, values))) <= 1
+            values = np.asarray(values) if same_type else np.asarray(values, dtype=object)
+        count = len(values)
+        timestamps = np.broadcast_to(np.asarray(timestamps, dtype=np.float64), (count,))
+        if len(streams) != count or (ids is not None and len(ids) != count):
+            self._logger.error("Input `streams`, `timestamps`, `values` and `ids` must have the same length")
+            return self
+        if count == 0:
+            return self
+
+        if self._validation != 'none':
+            for stream_id in np.unique(streams).tolist():
+                self._stream_id = stream_id
+                super()._validate()
+            self._stream_id = None
+
+        field_name = _FIELD_NAMES.get(values.dtype.kind)
+        if field_name is None: # mixed types
+            for stream_id, timestamp, value, id_ in zip(streams.tolist(), timestamps.tolist(), values.tolist(),
+                                                        ids if ids is not None else [None] * count):
+                self._add_entry(stream_id, timestamp, id_, value)
+            return self
+
+        # Group entries by (timestamp, id) in order of first appearance, as the chained
+        # calls do. Ids are used as they are, so they can mix None and strings.
+        if isinstance(ids, np.ndarray):
+            ids = ids.tolist()
+        group_index = {}
+        group = np.fromiter((group_index.setdefault(key, len(group_index)) for key in
+                             zip(timestamps.tolist(), ids if ids is not None else [None] * count)),
+                            dtype=np.intp, count=count)
+
+        order = np.argsort(group, kind='stable')
+        bounds = np.cumsum(np.bincount(group, minlength=len(group_index))).tolist()
+        sorted_streams = streams[order].tolist()
+        sorted_values = values[order].tolist()
+
+        start = 0
+        for (timestamp, id_), end in zip(group_index, bounds):
+            entry = self._get_entry(timestamp, id_, field_name)
+            entry[0].extend(sorted_streams[start:end])
+            entry[1].extend(sorted_values[start:end])
+            start = end
+        return self
+
     def get_data(self):
         self._flush()
         if not self._data:
@@ -41,11 +113,11 @@ class XVIZTimeSeriesBuilder(XVIZBaseBuilder):
         time_series_data = []
         for timestamp, ids in self._data.items():
             for id_, fields in ids.items():
-                for tsdata in fields.values():
+                for field_name, (streams, values) in fields.items():
                     entry = TimeSeriesState(
                         timestamp=timestamp,
-                        streams=tsdata['streams'],
-                        values=tsdata['values'],
+                        streams=streams,
+                        values={field_name: values},
                         object_id=id_
                     )
 
@@ -53,51 +125,46 @@ class XVIZTimeSeriesBuilder(XVIZBaseBuilder):
 
         return time_series_data
 
-    def _add_timestamp_entry(self):
-        # this._data structure
-        # timestamp: {
-        #   id: {
-        #     fieldName: {
-        #       streams: []
-        #       values: []
-        #     }
-        #   }
-        # }
-        if not self._data_pending():
-            return
-
-        if isinstance(self._value, str):
+    def _get_entry(self, timestamp, id_, field_name):
+        ts_entry = self._data.get(timestamp)
+        if ts_entry is None:
+            ts_entry = self._data[timestamp] = {}
+        id_entry = ts_entry.get(id_)
+        if id_entry is None:
+            id_entry = ts_entry[id_] = {}
+        field_entry = id_entry.get(field_name)
+        if field_entry is None:
+            field_entry = id_entry[field_name] = ([], [])
+        return field_entry
+
+    def _add_entry(self, stream_id, timestamp, id_, value):
+        if isinstance(value, str):
             field_name = "strings"
-        elif isinstance(self._value, bool):
+        elif isinstance(value, bool):
             field_name = "bools"
-        elif isinstance(self._value, int):
+        elif isinstance(value, int):
             field_name = "int32s"
-        elif isinstance(self._value, float):
+        elif isinstance(value, float):
             field_name = "doubles"
         else:
             self._logger.error("The type of input value is not recognized!")
+            return
 
-        ts_entry = self._data.get(self._timestamp)
-        if ts_entry:
-            id_entry = ts_entry.get(self._id)
-            if id_entry:
-                field_entry = id_entry.get(field_name)
-                if field_entry:
-                    field_entry['streams'].append(self._stream_id)
-                    field_entry['values'][field_name].append(self._value)
-                else:
-                    id_entry[field_name] = self._get_field_entry(field_name)
-            else:
-                ts_entry[self._id] = self._get_id_entry(field_name)
-        else:
-            ts_entry = {self._id: self._get_id_entry(field_name)}
-            self._data[self._timestamp] = ts_entry
+        entry = self._get_entry(timestamp, id_, field_name)
+        entry[0].append(stream_id)
+        entry[1].append(value)
 
-    def _get_id_entry(self, field_name):
-        return {field_name: self._get_field_entry(field_name)}
+    def _add_timestamp_entry(self):
+        # this._data structure
+        # timestamp: {
+        #   id: {
+        #     fieldName: (streams, values)
+        #   }
+        # }
+        if not self._data_pending():
+            return
 
-    def _get_field_entry(self, field_name):
-        return dict(streams=[self._stream_id], values={field_name: [self._value]})
+        self._add_entry(self._stream_id, self._timestamp, self._id, self._value)
 
     def _data_pending(self):
         return self._value or self._timestamp or self._id
@@ -110,7 +177,8 @@ class XVIZTimeSeriesBuilder(XVIZBaseBuilder):
             self._validate_has_prop("_timestamp")
 
     def _flush(self):
-        self._validate()
+        if self._validation != 'none':
+            self._validate()
         self._add_timestamp_entry()
         self.reset()
 
@@ -119,3 +187,7 @@ class XVIZTimeSeriesBuilder(XVIZBaseBuilder):
         self._id = None
         self._value = None
         self._timestamp = None
+
+    def clear(self):
+        super().clear()
+        self._data = {}
@@ -17,7 +17,26 @@ class XVIZTreeTableRowBuilder:
         return row
 
     def get_data(self):
-        return [self._node] + [node for child in self._children for node in child.get_data()]
+        return _flatten_rows([self])
+
+
+def _flatten_rows(rows):
+    '''
+    Get the nodes of rows and their descendants in depth-first order. Rows can also
+    be lists of nodes added in bulk, which are taken as they are.
+    '''
+    nodes = []
+    stack = list(reversed(rows))
+    while stack:
+        row = stack.pop()
+        if isinstance(row, list):
+            nodes.extend(row)
+            continue
+
+        nodes.append(row._node)
+        if row._children:
+            stack.extend(reversed(row._children))
+    return nodes
 
 
 class XVIZUIPrimitiveBuilder(XVIZBaseBuilder):
@@ -33,6 +52,10 @@ class XVIZUIPrimitiveBuilder(XVIZBaseBuilder):
         self._columns = None
         self._rows = []
 
+    def clear(self):
+        super().clear()
+        self._primitives = {}
+
     def treetable(self, columns):
         if self._type:
             self._flush()
@@ -53,8 +76,39 @@ class XVIZUIPrimitiveBuilder(XVIZBaseBuilder):
 
         return row
 
+    def rows(self, ids, parents, values):
+        '''
+        Add many treetable rows at once. Rows are added in the given order, so parents
+        should come before their children.
+
+        :param ids: id of each row
+        :param parents: parent id of each row, 0 or None for root rows
+        :param values: list of column values of each row
+        '''
+        if hasattr(ids, 'tolist'):
+            ids = ids.tolist()
+        if hasattr(parents, 'tolist'):
+            parents = parents.tolist()
+        if hasattr(values, 'tolist'):
+            values = values.tolist()
+        if len(ids) != len(parents) or len(ids) != len(values):
+            self._logger.error("Input `ids`, `parents` and `values` must have the same length")
+            return self
+
+        nodes = []
+        for id_, parent, row_values in zip(ids, parents, values):
+            node = TreeTableNode(id=id_, column_values=[str(v) for v in row_values])
+            if parent:
+                node.parent = parent
+            nodes.append(node)
+
+        self._rows.append(nodes)
+        self._type = UIPRIMITIVE_TYPES.TREETABLE
+        return self
+
     def _flush(self):
-        self._validate()
+        if self._validation != 'none':
+            self._validate()
         self._flush_primitive()
 
     def get_data(self):
@@ -73,7 +127,6 @@ class XVIZUIPrimitiveBuilder(XVIZBaseBuilder):
                 self._validate_has_prop('_columns')
                 self._primitives[self._stream_id].treetable.columns.extend(self._columns)
 
-            for row in self._rows:
-                self._primitives[self._stream_id].treetable.nodes.extend(row.get_data())
+            self._primitives[self._stream_id].treetable.nodes.extend(_flatten_rows(self._rows))
 
         self.reset()
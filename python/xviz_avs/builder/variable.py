@@ -1,3 +1,5 @@
+import numpy as np
+
 from xviz_avs.builder.base_builder import XVIZBaseBuilder, CATEGORY
 from xviz_avs.v2.core_pb2 import VariableState
 
@@ -9,6 +11,8 @@ class XVIZVariableBuilder(XVIZBaseBuilder):
         # Stores variable data by stream then id
         # They will then be group when constructing final object
         self._data = {}
+        # Object ids already added to each stream
+        self._ids = {}
 
         # inflight builder data
         self._id = None
@@ -27,6 +31,27 @@ class XVIZVariableBuilder(XVIZBaseBuilder):
         self._values = values
         return self
 
+    def values_by_id(self, values):
+        '''
+        Add the variables of many objects to the stream in one pass
+
+        :param values: dict of object id -> values, where values is a list, tuple or numpy array
+        '''
+        stream_id = self._stream_id
+        if self._data_pending():
+            self._flush()
+            self._stream_id = stream_id
+
+        if self._validation != 'none' and values:
+            super()._validate()
+
+        stream_entry, stream_ids = self._get_stream_entry()
+        for object_id, object_values in values.items():
+            if isinstance(object_values, np.ndarray):
+                object_values = object_values.tolist()
+            self._add_entry(stream_entry, stream_ids, object_id, object_values)
+        return self
+
     def get_data(self):
         self._flush()
         if not self._data:
@@ -34,39 +59,42 @@ class XVIZVariableBuilder(XVIZBaseBuilder):
 
         return self._data
 
-    def _add_variable_entry(self):
-        if not self._data_pending():
-            return
-
-        stream_entry = None
+    def _get_stream_entry(self):
         if self._stream_id not in self._data:
-            stream_entry = VariableState()
-            self._data[self._stream_id] = stream_entry
-        else:
-            stream_entry = self._data[self._stream_id]
-
-        if self._id:
-            for entry in stream_entry.variables:
-                if entry.base.object_id == self._id:
-                    # TODO validate error, which should throw
-                    self._logger.error("Input `values` already set for id %s" % self._id)
-                    raise Exception('id values already set')
+            self._data[self._stream_id] = VariableState()
+            self._ids[self._stream_id] = set()
+        return self._data[self._stream_id], self._ids[self._stream_id]
+
+    def _add_entry(self, stream_entry, stream_ids, object_id, values):
+        if object_id:
+            if object_id in stream_ids:
+                # TODO validate error, which should throw
+                self._logger.error("Input `values` already set for id %s" % object_id)
+                raise Exception('id values already set')
+            stream_ids.add(object_id)
 
         var_entry = stream_entry.variables.add()
-        value = self._values[0]
+        value = values[0]
         if isinstance(value, str):
-            var_entry.values.strings.extend(self._values)
+            var_entry.values.strings.extend(values)
         elif isinstance(value, bool):
-            var_entry.values.bools.extend(self._values)
+            var_entry.values.bools.extend(values)
         elif isinstance(value, int):
-            var_entry.values.int32s.extend(self._values)
+            var_entry.values.int32s.extend(values)
         elif isinstance(value, float):
-            var_entry.values.doubles.extend(self._values)
+            var_entry.values.doubles.extend(values)
         else:
             self._logger.error("The type of input value is not recognized!")
 
-        if self._id:
-            var_entry.base.object_id = self._id
+        if object_id:
+            var_entry.base.object_id = object_id
+
+    def _add_variable_entry(self):
+        if not self._data_pending():
+            return
+
+        stream_entry, stream_ids = self._get_stream_entry()
+        self._add_entry(stream_entry, stream_ids, self._id, self._values)
 
     def _data_pending(self):
         return self._values or self._id
@@ -78,7 +106,8 @@ class XVIZVariableBuilder(XVIZBaseBuilder):
                 self._logger.warning("Stream %s values are not provided" % self._stream_id)
 
     def _flush(self):
-        self._validate()
+        if self._validation != 'none':
+            self._validate()
         self._add_variable_entry()
         self.reset()
 
@@ -86,3 +115,8 @@ class XVIZVariableBuilder(XVIZBaseBuilder):
         super().reset()
         self._id = None
         self._values = None
+
+    def clear(self):
+        super().clear()
+        self._data = {}
+        self._ids = {}
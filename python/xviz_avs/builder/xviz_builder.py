@@ -3,6 +3,7 @@ from easydict import EasyDict as edict
 
 from xviz_avs.message import XVIZFrame, XVIZMessage
 
+from xviz_avs.builder.base_builder import compile_metadata
 from xviz_avs.builder.link import XVIZLinkBuilder
 from xviz_avs.builder.future_instance import XVIZFutureInstanceBuilder
 from xviz_avs.builder.pose import XVIZPoseBuilder
@@ -20,7 +21,13 @@ PRIMARY_POSE_STREAM = '/vehicle_pose'
 
 class XVIZBuilder:
     def __init__(self, metadata=None, disable_streams=None,
-                 logger=logging.getLogger("xviz")):
+                 logger=logging.getLogger("xviz"), validation='full'):
+        '''
+        :param validation: how streams are validated against metadata, 'full' checks the
+            metadata on every flush, 'compiled' compiles the metadata into a lookup table
+            once, 'strict' also checks the style properties of primitives and 'none'
+            disables the validation
+        '''
         self._logger = logger
         self._metadata = metadata
         self._disable_streams = disable_streams or []
@@ -35,6 +42,13 @@ class XVIZBuilder:
         self._future_instance_builder = XVIZFutureInstanceBuilder(self._metadata, self._logger)
         self._ui_primitives_builder = XVIZUIPrimitiveBuilder(self._metadata, self._logger)
         self._time_series_builder = XVIZTimeSeriesBuilder(self._metadata, self._logger)
+        self._builders = (self._links_builder, self._pose_builder, self._variables_builder,
+                          self._primitives_builder, self._future_instance_builder,
+                          self._ui_primitives_builder, self._time_series_builder)
+
+        stream_table = compile_metadata(self._metadata) if validation in ('compiled', 'strict') else None
+        for builder in self._builders:
+            builder.set_validation(validation, stream_table)
 
     def timestamp(self, ts):
         if self._timestamp != None:
@@ -53,7 +67,10 @@ class XVIZBuilder:
         self._stream_builder = self._primitives_builder.stream(stream_id)
         return self._stream_builder
 
-    def future_instance(self, stream_id, timestamp):
+    def future_instance(self, stream_id, timestamp=None):
+        '''
+        :param timestamp: timestamp of the future primitives, not needed for `trajectories`
+        '''
         self._stream_builder = self._future_instance_builder.stream(stream_id)
         self._stream_builder.timestamp(timestamp)
         return self._stream_builder
@@ -66,6 +83,13 @@ class XVIZBuilder:
         self._stream_builder = self._time_series_builder.stream(stream_id)
         return self._stream_builder
 
+    def time_series_columns(self, streams, timestamps, values, ids=None):
+        '''
+        Add time series values of many streams from parallel arrays, see `XVIZTimeSeriesBuilder.columns`
+        '''
+        self._stream_builder = self._time_series_builder.columns(streams, timestamps, values, ids)
+        return self._stream_builder
+
     def link(self, parent, child):
         self._stream_builder = self._links_builder.stream(child).parent(parent)
         return self._stream_builder
@@ -74,6 +98,15 @@ class XVIZBuilder:
         self._stream_builder = None
         self._timestamp = None
 
+    def reset(self):
+        '''
+        Clear the data of current frame while keeping the metadata and sub-builders,
+        so that one builder can be reused for every frame of a session
+        '''
+        self._reset()
+        for builder in self._builders:
+            builder.clear()
+
     def get_data(self):
         poses = self._pose_builder.get_data()
         ts = self._timestamp
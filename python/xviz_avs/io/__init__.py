@@ -1,4 +1,6 @@
 from xviz_avs.io.sources import MemorySource, DirectorySource, ZipSource, SQLiteSource
-from xviz_avs.io.json import XVIZJsonWriter
-from xviz_avs.io.gltf import XVIZGLBWriter
-from xviz_avs.io.protobuf import XVIZProtobufWriter
+from xviz_avs.io.json import XVIZJsonWriter, XVIZJsonReader
+from xviz_avs.io.gltf import XVIZGLBWriter, XVIZGLBReader
+from xviz_avs.io.protobuf import XVIZProtobufWriter, XVIZProtobufReader
+from xviz_avs.io.providers import XVIZBaseProvider, XVIZProviderFactory
+from xviz_avs.io.convert import convert_messages, convert_log
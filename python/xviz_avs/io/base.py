@@ -1,37 +1,155 @@
 from easydict import EasyDict as edict
 import json
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from xviz_avs.io.sources import BaseSource
-from xviz_avs.message import AllDataType, XVIZMessage, Metadata
+from xviz_avs.message import XVIZMessage, Metadata
+
+QUEUE_POLICIES = ('block', 'drop')
 
 class XVIZBaseWriter:
-    def __init__(self, source: BaseSource):
+    def __init__(self, source: BaseSource, suffix: str = None,
+                 async_workers: int = 0, max_queue_size: int = 16, queue_policy: str = 'block'):
         '''
         :param sink: object of type in xviz.io.sources
+        :param suffix: file extension of the messages, e.g. '.glb'
+        :param async_workers: number of threads encoding messages in background. If zero,
+            messages are encoded and written in `write_message`. Otherwise `write_message`
+            only queues the message, which must not be modified afterwards.
+        :param max_queue_size: maximum number of messages waiting to be encoded or written
+        :param queue_policy: what to do when the queue is full, 'block' waits until a message
+            is written and 'drop' discards the new message
         '''
         if source is None:
             raise ValueError("Data source must be specified!")
         self._source = source
+        self._suffix = suffix
         self._message_timings = dict(messages={})
         self._wrote_message_index = False
         self._counter = 2
 
+        if queue_policy not in QUEUE_POLICIES:
+            raise ValueError("Queue policy must be one of %s" % ', '.join(QUEUE_POLICIES))
+        self._queue_policy = queue_policy
+        self._dropped_count = 0
+        self._error = None
+        self._executor = None
+        self._queue = None
+        if async_workers > 0:
+            # Messages are encoded in parallel but persisted in order by a single thread
+            self._executor = ThreadPoolExecutor(async_workers, thread_name_prefix="xviz-writer")
+            self._queue = queue.Queue(max_queue_size)
+            self._persist_thread = threading.Thread(target=self._persist_loop, daemon=True)
+            self._persist_thread.start()
+
+    def write_message(self, message: XVIZMessage, index: int = None):
+        '''
+        Write the message into the source
+
+        :param message: the message to be written
+        :param index: explicit index of the message, by default messages are numbered sequentially
+        :return: False if the message is dropped because the queue is full, otherwise True
+        '''
+        self._check_valid()
+        if self._executor is None:
+            fname, entry = self._get_sequential_name(message, index)
+            self._write_encoded(self._encode_message(message), fname + self._suffix)
+            self._save_index_entry(entry)
+            return True
+
+        self._check_error()
+        if self._queue_policy == 'drop' and self._queue.full():
+            self._dropped_count += 1
+            return False
+
+        fname, entry = self._get_sequential_name(message, index)
+        future = self._executor.submit(self._encode_message, message)
+        self._queue.put((future, fname + self._suffix, entry))
+        return True
+
+    def flush(self):
+        '''
+        Wait until all the queued messages are written into the source
+        '''
+        if self._executor is not None:
+            self._queue.join()
+            self._check_error()
+
+    @property
+    def queue_depth(self) -> int:
+        '''
+        Number of messages that are queued but not written yet
+        '''
+        return self._queue.unfinished_tasks if self._queue else 0
+
+    @property
+    def dropped_count(self) -> int:
+        '''
+        Number of messages discarded because the queue was full
+        '''
+        return self._dropped_count
+
+    def _encode_message(self, message: XVIZMessage):
+        raise NotImplementedError("Derived class should implement this method")
+
+    def _write_encoded(self, data, fname: str):
+        self._source.write(data, fname)
+
+    def _persist_loop(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                future, fname, entry = item
+                self._write_encoded(future.result(), fname)
+                self._save_index_entry(entry)
+            except Exception as e: # reported to the producer in write_message or flush
+                if self._error is None:
+                    self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _check_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
     def _get_sequential_name(self, message: XVIZMessage, index=None):
-        raw_data = message.data
+        '''
+        Get the name of the message and its entry in the message index. The entry should be
+        saved by `_save_index_entry` only after the message is persisted, so that the index
+        doesn't refer to messages that are dropped or failed to be written.
+
+        :return: tuple of (name, index entry)
+        '''
+        raw_data = message.readonly_data
         if isinstance(raw_data, Metadata):
-            self._save_timestamp(raw_data)
-            fname = "1-frame"
-        else:
-            if not index:
-                index = self._counter
-                self._counter += 1
+            return "1-frame", self._get_index_entry(raw_data)
 
-            self._save_timestamp(raw_data, index)
-            fname = "%d-frame" % index
-        return fname
+        if not raw_data.updates:
+            raise ValueError("Cannot find timestamp")
+        times = [update.timestamp for update in raw_data.updates]
+        return self._get_timed_name(min(times), max(times), index)
+
+    def _get_timed_name(self, start_time: float, end_time: float, index=None):
+        '''
+        Same as `_get_sequential_name` for a state update whose time range is already known,
+        e.g. from the index of the log it's read from
+        '''
+        if not index:
+            index = self._counter
+            self._counter += 1
+
+        fname = "%d-frame" % index
+        return fname, (index, (start_time, end_time, index - 2, fname))
 
     def _write_message_index(self):
         self._check_valid()
+        if self._executor is not None:
+            self._queue.join() # entries are saved when the queued messages are persisted
 
         message_timings = {}
         start_time = self._message_timings.get('start_time')
@@ -51,28 +169,119 @@ class XVIZBaseWriter:
         Write timestamp list into the sink and then close the source.
         '''
         if self._source:
+            if self._executor is not None:
+                self._queue.join()
+                self._queue.put(None)
+                self._persist_thread.join()
+                self._executor.shutdown()
+                self._executor = None
             self._write_message_index()
             self._source.close()
             self._source = None
+            self._check_error()
 
     def _check_valid(self):
         if not self._source:
             raise ValueError("The writer has been closed!")
 
-    def _save_timestamp(self, xviz_data: AllDataType, index: int = None):
-        if index: # normal data
-            if not xviz_data.updates:
-                raise ValueError("Cannot find timestamp")
-
-            times = [update.timestamp for update in xviz_data.updates]
-            tmin, tmax = min(times), max(times)
+    def _get_index_entry(self, metadata: Metadata):
+        if metadata.HasField('log_info'):
+            return None, dict(start_time=metadata.log_info.start_time,
+                              end_time=metadata.log_info.end_time)
+        return None, {}
 
-            self._message_timings['messages'][index] = (tmin, tmax, index - 2, "%d-frame" % index)
-        else: # metadata
-            if xviz_data.HasField('log_info'):
-                self._message_timings['start_time'] = xviz_data.log_info.start_time
-                self._message_timings['end_time'] = xviz_data.log_info.end_time
+    def _save_index_entry(self, entry):
+        index, value = entry
+        if index is None: # metadata
+            self._message_timings.update(value)
+        else:
+            self._message_timings['messages'][index] = value
 
 class XVIZBaseReader:
-    def __init__(self, source):
-        raise NotImplementedError()
+    # whether the encoded messages are binary data rather than text
+    binary = True
+
+    def __init__(self, source: BaseSource, suffix: str = '-frame.json'):
+        '''
+        :param source: object of type in xviz.io.sources
+        :param suffix: suffix of the message names, e.g. '-frame.glb'
+        '''
+        if source is None:
+            raise ValueError("Data source must be specified!")
+        self._source = source
+        self._suffix = suffix
+
+        # Index schema:
+        # startTime, endTime, timing: [[min_message_time, max_message_time, index, name], ...]
+        self._index = self._read_index()
+
+    def read_metadata(self):
+        '''
+        Read and parse the metadata message (1-frame)
+        '''
+        self._check_valid()
+        return self._parse_message(self._source.read(self._get_name(1)))
+
+    def read_message(self, index: int):
+        '''
+        Read and parse a data message. Data messages begin at 2-frame, so index 0
+        refers to the file 2-frame.
+        '''
+        self._check_valid()
+        return self._parse_message(self._source.read(self._get_name(2 + index)))
+
+    def read_metadata_data(self):
+        '''
+        Read the metadata message as encoded data without parsing it
+        '''
+        self._check_valid()
+        return self._source.read(self._get_name(1))
+
+    def read_message_data(self, index: int):
+        '''
+        Read a data message as encoded data without parsing it. Index is the same as `read_message`.
+        '''
+        self._check_valid()
+        return self._source.read(self._get_name(2 + index))
+
+    def time_range(self):
+        if self._index:
+            return self._index.get('startTime'), self._index.get('endTime')
+        return None, None
+
+    def message_count(self):
+        if self._index:
+            return len(self._index['timing'])
+        return None
+
+    @property
+    def index(self):
+        return self._index
+
+    @property
+    def suffix(self) -> str:
+        return self._suffix
+
+    def close(self):
+        if self._source:
+            self._source.close()
+            self._source = None
+
+    def _check_valid(self):
+        if not self._source:
+            raise ValueError("The reader has been closed!")
+
+    def _get_name(self, index: int):
+        if index == 0:
+            return '0-frame.json'
+        return '%d%s' % (index, self._suffix)
+
+    def _read_index(self):
+        try:
+            data = self._source.read(self._get_name(0))
+        except (IOError, KeyError):
+            return None
+        return json.loads(bytes(data))
+
+    def _parse_message(self, data):
+        raise NotImplementedError("Derived class should implement this method")
@@ -0,0 +1,124 @@
+'''
+This module provides batch conversion of XVIZ logs using a pool of processes.
+'''
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from xviz_avs.io.gltf import XVIZGLBWriter
+from xviz_avs.io.protobuf import XVIZProtobufReader, XVIZProtobufData, PBE_MAGIC
+from xviz_avs.io.providers import XVIZProviderFactory
+from xviz_avs.io.sources import MemorySource
+
+# Writer used to encode messages in each worker process
+_worker_writer = None
+
+def _init_worker(writer_class, writer_options):
+    global _worker_writer
+    _worker_writer = writer_class(MemorySource(latest_only=True), **writer_options)
+
+def _encode_message(message_type: str, payload: bytes) -> bytes:
+    # protobuf classes cannot be pickled, so messages are passed in serialized form
+    message = XVIZProtobufData(PBE_MAGIC + payload, message_type).message
+    _worker_writer._write_encoded(_worker_writer._encode_message(message), None)
+    return _worker_writer._source.read()
+
+def _convert(tasks, sink, writer_class, max_workers, max_pending, writer_options):
+    '''
+    Encode the messages in worker processes and write them in order
+
+    :param tasks: iterable of (index entry function, message type, payload), the type is None
+        for payloads wrapped in Envelope. The function takes the parent writer and returns
+        the name and the index entry of the message.
+    '''
+    max_workers = max_workers or os.cpu_count() or 1
+    max_pending = max_pending or 4 * max_workers
+
+    # this writer only names the messages and writes the index
+    writer = writer_class(sink)
+    completed = False
+    pending = deque()
+    try:
+        with ProcessPoolExecutor(max_workers, initializer=_init_worker,
+                                 initargs=(writer_class, writer_options)) as executor:
+            for get_name, message_type, payload in tasks:
+                if len(pending) >= max_pending:
+                    future, fname, entry = pending.popleft()
+                    sink.write(future.result(), fname)
+                    writer._save_index_entry(entry)
+
+                fname, entry = get_name(writer)
+                future = executor.submit(_encode_message, message_type, payload)
+                pending.append((future, fname + writer._suffix, entry))
+
+            while pending:
+                future, fname, entry = pending.popleft()
+                sink.write(future.result(), fname)
+                writer._save_index_entry(entry)
+        completed = True
+    finally:
+        if completed:
+            writer.close()
+        else: # the messages written are kept, but without index
+            for future, _, _ in pending:
+                future.cancel()
+            sink.close()
+
+def convert_messages(messages, sink, writer_class=XVIZGLBWriter, max_workers=None,
+                     max_pending=None, **writer_options):
+    '''
+    Encode messages in worker processes and write them into sink. The parent process assigns
+    the message names and builds the message index, so the files and the index are the same as
+    writing the messages sequentially with `writer_class`. The content of a file can differ only
+    in the order of map entries (e.g. streams of a frame), because protobuf map order is not
+    stable between processes. The sink is closed after conversion, also on errors.
+
+    :param messages: iterable of XVIZMessage, the metadata should come first
+    :param sink: object of type in xviz.io.sources, closed after conversion
+    :param writer_class: writer class that defines the output format
+    :param max_workers: number of worker processes, default to the number of CPUs
+    :param max_pending: maximum number of messages being encoded, default to 4 per worker
+    :param writer_options: encoding options passed to `writer_class` in the workers, the
+        writer of the parent process only names the messages and writes the index
+    '''
+    def tasks():
+        for message in messages:
+            yield (lambda writer, message=message: writer._get_sequential_name(message),
+                   message.get_schema().replace("session", "xviz"), message.to_bytes())
+
+    _convert(tasks(), sink, writer_class, max_workers, max_pending, writer_options)
+
+def convert_log(source, sink, writer_class=XVIZGLBWriter, max_workers=None,
+                max_pending=None, **writer_options):
+    '''
+    Convert a log written in protobuf (PBE) format into the format of `writer_class`, see
+    `convert_messages` for the parameters. Logs in JSON or GLB format are rejected, since
+    their readers don't return protobuf messages.
+
+    Only the metadata is decoded in this process. The other messages are passed to the
+    workers as read, and they are named and indexed from the index of the log.
+    '''
+    provider = XVIZProviderFactory().open(source)
+    if provider is None:
+        raise ValueError("Cannot find a valid XVIZ log in the source")
+    if not isinstance(provider.reader, XVIZProtobufReader):
+        provider.close()
+        raise ValueError("Only logs in protobuf format can be converted, got %s"
+                         % type(provider.reader).__name__)
+
+    def tasks():
+        metadata = provider.xviz_metadata()
+        yield (lambda writer: writer._get_sequential_name(metadata.message),
+               None if metadata.wrapped else metadata.type, bytes(metadata.buffer))
+
+        for position in provider.get_message_iterator():
+            data = provider.xviz_message(position)
+            start_time, end_time = provider.message_time_range(position)
+            yield (lambda writer, start_time=start_time, end_time=end_time:
+                       writer._get_timed_name(start_time, end_time),
+                   None if data.wrapped else data.type, bytes(data.buffer))
+
+    try:
+        _convert(tasks(), sink, writer_class, max_workers, max_pending, writer_options)
+    finally:
+        provider.close()
@@ -3,13 +3,16 @@ This module provides basic io under GLTF format
 """
 
 import logging
-import json, array, struct, base64
+import json, array, struct
 from typing import Union
 from collections import namedtuple
+import numpy as np
 from easydict import EasyDict as edict
+from google.protobuf.json_format import MessageToDict
 
-from xviz_avs.io.base import XVIZBaseWriter
-from xviz_avs.message import XVIZMessage, XVIZEnvelope, StateUpdate
+from xviz_avs.io.base import XVIZBaseWriter, XVIZBaseReader
+from xviz_avs.message import XVIZMessage, XVIZEnvelope, StateUpdate, _unravel_style_object
+from xviz_avs.v2.core_pb2 import StreamSet
 
 # Constants
 
@@ -25,12 +28,50 @@ component_type_d = {
   'I' : 5125,
   'f' : 5126
 }
+component_dtype_d = {
+  5120 : np.int8,
+  5121 : np.uint8,
+  5122 : np.int16,
+  5123 : np.uint16,
+  5125 : np.uint32,
+  5126 : np.float32
+}
 types_d = ['SCALAR', 'VEC2', 'VEC3', 'VEC4']
 XVIZ_GLTF_EXTENSION = 'AVS_xviz'
 
 def pad_to_4bytes(length):
     return (length + 3) & ~3
 
+def _buffer_component_type(buffer) -> int:
+    '''
+    Get the glTF component type of the elements in a typed buffer
+    '''
+    if isinstance(buffer, array.array):
+        typecode = buffer.typecode
+    elif isinstance(buffer, np.ndarray):
+        typecode = buffer.dtype.char
+    elif isinstance(buffer, memoryview):
+        typecode = buffer.format.lstrip('@=<')
+    else:
+        typecode = 'B'
+
+    if typecode not in component_type_d:
+        raise ValueError("Unsupported buffer element type: %s" % typecode)
+    return component_type_d[typecode]
+
+def _as_byte_view(buffer) -> memoryview:
+    '''
+    Get a flat byte view of a bytes-like object without copying it
+    '''
+    if isinstance(buffer, np.ndarray) and not buffer.flags.c_contiguous:
+        buffer = np.ascontiguousarray(buffer)
+    try:
+        view = memoryview(buffer)
+    except TypeError:
+        raise ValueError("add_buffer_view should be used with a bytes-like object, got %s"
+                         % type(buffer).__name__)
+    return view if view.format == 'B' and view.ndim == 1 else view.cast('B')
+
 # Wrappers
 class ImageWrapper:
     def __init__(self, image: bytes, width: int = None, height: int = None, mime_type: str = None):
@@ -91,53 +132,52 @@ class GLTFBuilder:
         )._asdict())
         return len(self._json.accessors) - 1
 
-    def add_buffer_view(self, buffer: bytes):
+    def add_buffer_view(self, buffer):
         '''
         Add one untyped source buffer, create a matching glTF `bufferView`,
-        and return its index
+        and return its index. The buffer is referenced rather than copied,
+        so it should not be modified before `flush`.
 
-        :param buffer: bytes
+        :param buffer: bytes-like object (bytes, memoryview, numpy array, array.array)
         :return: buffer_view_index: The index of inserted bufferView
         '''
-        if not isinstance(buffer, bytes):
-            raise ValueError("add_buffer_view should be directly used with bytes")
+        view = _as_byte_view(buffer)
+        byte_length = len(view)
 
         self._json.bufferViews.append(bufferView_t(
             buffer=0,
             byteOffset=self._byte_length,
-            byteLength=len(buffer)
+            byteLength=byte_length
         )._asdict())
 
-        # Pad array
-        pad_len = pad_to_4bytes(len(buffer))
-        buffer += b'\x00' * (pad_len - len(buffer))
+        # Padding is kept as a separate segment so that the buffer is never copied
+        self._source_buffers.append(view)
+        pad_len = pad_to_4bytes(byte_length)
+        if pad_len > byte_length:
+            self._source_buffers.append(b'\x00' * (pad_len - byte_length))
         self._byte_length += pad_len
-        self._source_buffers.append(buffer)
 
         return len(self._json.bufferViews) - 1
 
-    def add_buffer(self, buffer: Union[array.array, bytes], size: int = 3):
+    def add_buffer(self, buffer: Union[array.array, np.ndarray, memoryview, bytes], size: int = 3):
         '''
         Add a binary buffer. Builds glTF "JSON metadata" and saves buffer reference.
-        Buffer will be copied into BIN chunk during "pack".
+        Buffer will be written into BIN chunk during "flush".
         Currently encodes buffers as glTF accessors, but this could be optimized.
 
-        :param buffer: flattened array or byte string
-        :param size: XXX
-        :param component_type: XXX
-        :param count: XXX
+        :param buffer: flattened typed array or byte string. The component type is
+            derived from the element type of the buffer
+        :param size: number of components in each element (e.g. 3 for points)
         :return: accessor_index: Index of added buffer in "accessors" list
         '''
-        if isinstance(buffer, array.array):
-            buffer_view_index = self.add_buffer_view(buffer.tobytes())
-            return self.add_accessor(
-                buffer_view_index, size=size,
-                component_type=component_type_d[buffer.typecode], count=len(buffer) // size)
-        else:
-            buffer_view_index = self.add_buffer_view(buffer)
-            return self.add_accessor(
-                buffer_view_index, size=size,
-                component_type=component_type_d['B'], count=len(buffer) // size)
+        component_type = _buffer_component_type(buffer)
+        itemsize = memoryview(buffer).itemsize
+        buffer_view_index = self.add_buffer_view(buffer)
+        # counted from the flat byte length, multi-dimensional views have the length of the first axis
+        count = self._json.bufferViews[buffer_view_index]['byteLength'] // itemsize
+        return self.add_accessor(
+            buffer_view_index, size=size,
+            component_type=component_type, count=count // size)
 
     def add_application_data(self, key: str, data):
         '''
@@ -202,29 +242,18 @@ class GLTFBuilder:
 
         # Prepare data
         self._json.buffers = [{"byteLength": self._byte_length}]
-        binary = b''.join(self._source_buffers)
         jsonstr = json.dumps(self._json, separators=(',', ':')).encode('ascii')
         jsonlen = pad_to_4bytes(len(jsonstr))
+        binlen = self._byte_length
 
-        assert len(binary) == pad_to_4bytes(len(binary)), "Something wrong in binary padding"
-        binlen = len(binary)
+        # Header, padded JSON chunk and BIN chunk header
+        header = struct.pack("<IIIII", self.MAGIC_glTF, self._version, 28 + jsonlen + binlen,
+                             jsonlen, self.MAGIC_JSON)
+        binheader = struct.pack("<II", binlen, self.MAGIC_BIN)
 
-        # Write GLB header
-        file.write(struct.pack("<I", self.MAGIC_glTF))
-        file.write(struct.pack("<I", self._version))
-        file.write(struct.pack("<I", 28 + jsonlen + binlen))
-
-        # Write Json
-        file.write(struct.pack("<I", jsonlen))
-        file.write(struct.pack("<I", self.MAGIC_JSON))
-        file.write(jsonstr)
-        file.write(b" " * (jsonlen - len(jsonstr))) # pad json with spaces
-
-        # Write Binary
-        file.write(struct.pack("<I", binlen))
-        file.write(struct.pack("<I", self.MAGIC_BIN))
-        file.write(binary)
-        file.write(b"\x00" * (binlen - len(binary))) # pad
+        # Write source buffers segment by segment instead of joining them
+        file.writelines([header, jsonstr, b" " * (jsonlen - len(jsonstr)), binheader])
+        file.writelines(self._source_buffers)
 
     ################ glTF Applications ##############
 
@@ -262,80 +291,221 @@ class GLTFBuilder:
     def add_compressed_point_cloud(self, attributes):
         raise NotImplementedError()
 
+class GLTFParser:
+    """
+    Parse a GLB file built by GLTFBuilder. Accessors and images are returned as numpy arrays
+    that share memory with the input buffer, so no binary data is copied. Note that the
+    arrays are read-only if the input buffer is immutable (e.g. bytes).
+
+    # Reference
+    [GLBParser](https://github.com/uber-web/loaders.gl/blob/master/modules/gltf/src/lib/deprecated/glb-parser.js)
+    from [@loaders.gl/gltf](https://github.com/uber-web/loaders.gl/blob/master/modules/gltf/README.md)
+    """
+    def __init__(self, buffer):
+        '''
+        :param buffer: bytes-like object containing the whole GLB file
+        '''
+        self._buffer = memoryview(buffer).cast('B')
+
+        magic, version, length = struct.unpack_from("<III", self._buffer, 0)
+        if magic != GLTFBuilder.MAGIC_glTF:
+            raise ValueError("Invalid GLB magic string")
+        if version != 2:
+            raise ValueError("Unsupported GLB version %d" % version)
+        if length > len(self._buffer):
+            raise ValueError("GLB data is truncated")
+
+        jsonlen, jsonmagic = struct.unpack_from("<II", self._buffer, 12)
+        if jsonmagic != GLTFBuilder.MAGIC_JSON:
+            raise ValueError("First GLB chunk must be JSON")
+        self._json = json.loads(bytes(self._buffer[20:20 + jsonlen]))
+
+        bin_start = 20 + jsonlen
+        if bin_start + 8 <= length:
+            binlen, binmagic = struct.unpack_from("<II", self._buffer, bin_start)
+            if binmagic != GLTFBuilder.MAGIC_BIN:
+                raise ValueError("Second GLB chunk must be BIN")
+            self._binary = self._buffer[bin_start + 8:bin_start + 8 + binlen]
+        else:
+            self._binary = self._buffer[0:0]
+
+    @property
+    def json(self) -> dict:
+        return self._json
+
+    @property
+    def binary(self) -> memoryview:
+        return self._binary
+
+    def get_buffer_view(self, buffer_view_index: int) -> memoryview:
+        view = self._json['bufferViews'][buffer_view_index]
+        offset = view.get('byteOffset', 0)
+        return self._binary[offset:offset + view['byteLength']]
+
+    def get_accessor(self, accessor_index: int) -> np.ndarray:
+        '''
+        Get the accessor data as numpy array in shape (count, size), or (count,) for scalars
+        '''
+        accessor = self._json['accessors'][accessor_index]
+        size = types_d.index(accessor['type']) + 1
+        view = self._json['bufferViews'][accessor['bufferView']]
+        array = np.frombuffer(self._binary,
+            dtype=component_dtype_d[accessor['componentType']],
+            count=accessor['count'] * size,
+            offset=view.get('byteOffset', 0) + accessor.get('byteOffset', 0))
+        return array if size == 1 else array.reshape(-1, size)
+
+    def get_image(self, image_index: int) -> np.ndarray:
+        '''
+        Get the encoded image bytes as uint8 numpy array
+        '''
+        image = self._json['images'][image_index]
+        return np.frombuffer(self.get_buffer_view(image['bufferView']), dtype=np.uint8)
+
+    def unpack_binary_json(self, data):
+        '''
+        Resolve the JSON pointers created by `GLTFBuilder.pack_binary_json`
+        '''
+        if isinstance(data, str):
+            if data.startswith("##/"): # escaped string
+                return data[1:]
+            if data.startswith("#/accessors/"):
+                return self.get_accessor(int(data[12:]))
+            if data.startswith("#/images/"):
+                return self.get_image(int(data[9:]))
+            return data
+
+        if isinstance(data, list):
+            return [self.unpack_binary_json(obj) for obj in data]
+        if isinstance(data, dict):
+            return {k:self.unpack_binary_json(v) for k, v in data.items()}
+
+        return data
+
+# Primitive fields that are moved into the BIN chunk instead of the JSON chunk
+BINARY_PRIMITIVE_FIELDS = {
+    'points': ('points', 'colors'),
+    'polylines': ('vertices',),
+    'polygons': ('vertices',),
+    'images': ('data',),
+}
+
+def _copy_fields(src, dst, excluded=()):
+    '''
+    Copy the set fields of protobuf message `src` into `dst`, skipping fields in `excluded`
+    '''
+    for field, value in src.ListFields():
+        if field.name in excluded:
+            continue
+        if hasattr(value, 'MergeFrom'): # message, map or repeated field
+            getattr(dst, field.name).MergeFrom(value)
+        else:
+            setattr(dst, field.name, value)
+
+def _message_to_object(message, excluded=()):
+    '''
+    Convert the fields of message into dict except the fields in `excluded`, which are
+    left out of the result. Key order is the same as `MessageToDict` output.
+    '''
+    if not excluded:
+        return MessageToDict(message, preserving_proto_field_name=True)
+
+    light = type(message)()
+    _copy_fields(message, light, excluded)
+    return MessageToDict(light, preserving_proto_field_name=True)
+
+def _primitive_to_object(category: str, primitive):
+    '''
+    Convert a primitive into dict, with binary data wrapped by TypedArrayWrapper or ImageWrapper
+    '''
+    binary_fields = BINARY_PRIMITIVE_FIELDS.get(category, ())
+    lightobj = _message_to_object(primitive, binary_fields)
+
+    obj = {}
+    num_points = None
+    for field, value in primitive.ListFields():
+        name = field.name
+        if name not in binary_fields:
+            obj[name] = lightobj[name]
+        elif name == 'colors':
+            # infer size from num_points
+            assert num_points is not None
+            size = len(value) // num_points
+            assert size in (3, 4), 'expecting size to be 3 or 4, got %s' % size
+            obj[name] = TypedArrayWrapper(array=value, size=size)
+        elif name == 'data':
+            obj[name] = ImageWrapper(
+                image=value,
+                width=primitive.width_px,
+                height=primitive.height_px,
+                mime_type='image/png', # FIXME: use Pillow to detect type
+            )
+        else: # points or vertices
+            num_points = len(value) // 3
+            obj[name] = TypedArrayWrapper(array=array.array('f', value), size=3)
+
+    if 'base' in obj and 'style' in obj['base']:
+        _unravel_style_object(obj['base']['style'])
+    return obj
+
+def _stream_set_to_object(frame: StreamSet):
+    '''
+    Convert a frame into dict directly from protobuf. The output is the same as
+    `XVIZFrame.to_object()` except that binary data are wrapped for GLB packing.
+    '''
+    lightobj = _message_to_object(frame, ('primitives',))
+
+    obj = {}
+    for field, value in frame.ListFields():
+        if field.name != 'primitives':
+            obj[field.name] = lightobj[field.name]
+            continue
+
+        primitives = {}
+        for stream_id in value:
+            primitives[stream_id] = {
+                pfield.name: [_primitive_to_object(pfield.name, p) for p in plist]
+                for pfield, plist in value[stream_id].ListFields()
+            }
+        obj['primitives'] = primitives
+    return obj
+
 class XVIZGLBWriter(XVIZBaseWriter):
-    def __init__(self, sink, wrap_envelope=True, use_xviz_extension=True):
+    def __init__(self, sink, wrap_envelope=True, use_xviz_extension=True, **kwargs):
+        '''
+        :param kwargs: background encoding options, see XVIZBaseWriter
+        '''
         # TODO: also support precision limit in GLTF Json
-        super().__init__(sink)
+        super().__init__(sink, suffix='.glb', **kwargs)
 
         self._use_xviz_extension = use_xviz_extension
         self._wrap_envelop = wrap_envelope
         self._counter = 2
 
-    def write_message(self, message: XVIZMessage, index: int = None):
+    def _encode_message(self, message: XVIZMessage):
+        # The builder keeps the packed buffers and can be flushed repeatedly
+        key = ('glb', self._wrap_envelop, self._use_xviz_extension)
+        return message.get_encoded(key, lambda: self._build_glb(message))
 
-        self._check_valid()
-        if self._wrap_envelop:
-            obj = XVIZEnvelope(message).to_object()
-        else:
-            obj = message.to_object()
+    def _build_glb(self, message: XVIZMessage):
         builder = GLTFBuilder()
 
-        fname = self._get_sequential_name(message, index) + '.glb'
-
-        if isinstance(message.data, StateUpdate):
-            # Wrap image data and point cloud
+        data = message.readonly_data
+        if isinstance(data, StateUpdate):
+            # Walk the protobuf directly to avoid serializing binary data into JSON
+            obj = {
+                'update_type': StateUpdate.UpdateType.Name(data.update_type),
+                'updates': [_stream_set_to_object(frame) for frame in data.updates]
+            }
             if self._wrap_envelop:
-                dataobjs = obj['data']['updates']
-            else:
-                dataobjs = obj['updates']
-
-            for dataobj in dataobjs:
-                if 'primitives' in dataobj:
-                    for pdata in dataobj['primitives'].values():
-                        # convert lists into typed arrays to leverage binary format
-                        if 'points' in pdata:
-                            for pldata in pdata['points']:
-                                num_points = None
-                                if 'points' in pldata:
-                                    num_points = len(pldata['points']) // 3
-                                    pldata['points'] = TypedArrayWrapper(
-                                        array=array.array('f', pldata['points']),
-                                        size=3,
-                                    )
-                                if 'colors' in pldata:
-                                    # infer size from num_points
-                                    assert num_points is not None
-                                    color_bytes = bytes(pldata['colors'])
-                                    size = len(color_bytes) // num_points
-                                    assert size in (3, 4), 'expecting size to be 3 or 4, got %s' % size
-                                    pldata['colors'] = TypedArrayWrapper(
-                                        array=color_bytes,
-                                        size=size,
-                                    )
-                        if 'polylines' in pdata:
-                            for pldata in pdata['polylines']:
-                                if 'vertices' in pldata:
-                                    pldata['vertices'] = TypedArrayWrapper(
-                                        array=array.array('f', pldata['vertices']),
-                                        size=3,
-                                    )
-                        if 'polygons' in pdata:
-                            for pldata in pdata['polygons']:
-                                if 'vertices' in pldata:
-                                    pldata['vertices'] = TypedArrayWrapper(
-                                        array=array.array('f', pldata['vertices']),
-                                        size=3,
-                                    )
-
-                        # process images
-                        if 'images' in pdata:
-                            for imdata in pdata['images']:
-                                imdata['data'] = ImageWrapper(
-                                    image=base64.b64decode(imdata['data']),
-                                    width=imdata['width_px'],
-                                    height=imdata['height_px'],
-                                    mime_type='image/png', # FIXME: use Pillow to detect type
-                                )
+                obj = {
+                    'type': message.get_schema().replace("session", "xviz"),
+                    'data': obj
+                }
+        elif self._wrap_envelop:
+            obj = XVIZEnvelope(message).to_object()
+        else:
+            obj = message.to_object()
 
         # Encode GLB into file
         packed_data = builder.pack_binary_json(obj)
@@ -343,6 +513,27 @@ class XVIZGLBWriter(XVIZBaseWriter):
             builder.add_extension(XVIZ_GLTF_EXTENSION, packed_data)
         else:
             builder.add_application_data('xviz', packed_data)
+        return builder
 
+    def _write_encoded(self, builder: GLTFBuilder, fname: str):
         with self._source.open(fname, mode='w') as fout:
             builder.flush(fout)
+
+class XVIZGLBReader(XVIZBaseReader):
+    '''
+    Read messages written by XVIZGLBWriter. Binary data (points, vertices, colors, images)
+    are returned as numpy arrays viewing the buffer read from the source.
+    '''
+    def __init__(self, source):
+        super().__init__(source, suffix='-frame.glb')
+
+    def _parse_message(self, data):
+        parser = GLTFParser(data)
+        gltf = parser.json
+        if XVIZ_GLTF_EXTENSION in gltf.get('extensions', {}):
+            xviz = gltf['extensions'][XVIZ_GLTF_EXTENSION]
+        elif 'xviz' in gltf:
+            xviz = gltf['xviz']
+        else:
+            raise ValueError("The GLB data does not contain XVIZ message")
+        return parser.unpack_binary_json(xviz)
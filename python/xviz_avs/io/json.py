@@ -1,30 +1,84 @@
 import json
-from .base import XVIZBaseWriter
+from .base import XVIZBaseWriter, XVIZBaseReader
 
 from xviz_avs.message import XVIZEnvelope, XVIZMessage, Metadata
 
+def _dumps_rounded_by_token(obj, precision: int) -> str:
+    '''
+    Encode obj and round each token of the encoder that can be parsed as a number.
+    Tokens in arrays carry the separator, so only the numbers in dict values are rounded.
+    '''
+    result = [] # These codes are for float truncation
+    for part in json.JSONEncoder(separators=(',', ':')).iterencode(obj):
+        try:
+            rounded = round(float(part), precision)
+        except ValueError:
+            pass
+        else: part = str(rounded)
+        result.append(part)
+    return ''.join(result)
+
+def _round_numbers(obj, precision: int):
+    '''
+    Return a copy of obj with the numbers in dict values rounded, in the same way as
+    _dumps_rounded_by_token. The input is not modified, lists without nested dicts or lists
+    are shared with the result.
+    '''
+    if isinstance(obj, dict):
+        result = {}
+        for key, value in obj.items():
+            if isinstance(value, (dict, list)):
+                value = _round_numbers(value, precision)
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                value = round(float(value), precision)
+            result[key] = value
+        return result
+    if any(isinstance(value, (dict, list)) for value in obj):
+        # numbers directly in lists are not rounded, each item is checked for nested values
+        return [_round_numbers(value, precision) if isinstance(value, (dict, list)) else value
+                for value in obj]
+    return obj
+
+def _dumps_rounded(obj, precision: int) -> str:
+    return json.dumps(_round_numbers(obj, precision), separators=(',', ':'))
+
 class XVIZJsonWriter(XVIZBaseWriter):
-    def __init__(self, sink, wrap_envelope=True, float_precision=10, as_array_buffer=False):
-        super().__init__(sink)
+    def __init__(self, sink, wrap_envelope=True, float_precision=10, as_array_buffer=False,
+                 fast_encoding=True, **kwargs):
+        '''
+        :param fast_encoding: round the numbers while walking the data and encode with the C
+            encoder. Otherwise every token emitted by the encoder is parsed and rounded, which
+            gives the same output but is much slower for large arrays.
+        :param kwargs: background encoding options, see XVIZBaseWriter
+        '''
+        super().__init__(sink, suffix='.json', **kwargs)
         self._wrap_envelop = wrap_envelope
         self._json_precision = float_precision
+        self._fast_encoding = fast_encoding
+
+    def _encode_message(self, message: XVIZMessage):
+        key = ('json', self._wrap_envelop, self._json_precision)
+        return message.get_encoded(key, lambda: self._encode_json(message))
 
-    def write_message(self, message: XVIZMessage, index: int = None):
-        self._check_valid()
+    def _encode_json(self, message: XVIZMessage):
         if self._wrap_envelop:
             obj = XVIZEnvelope(message).to_object()
         else:
             obj = message.to_object()
 
-        fname = self._get_sequential_name(message, index) + '.json'
-
-        # Encode GLB into file
-        result = [] # These codes are for float truncation
-        for part in json.JSONEncoder(separators=(',', ':')).iterencode(obj):
-            try:
-                rounded = round(float(part), self._json_precision)
-            except ValueError:
-                pass
-            else: part = str(rounded)
-            result.append(part)
-        self._source.write(''.join(result).encode('ascii'), fname)
+        # Encode JSON into bytes
+        if self._fast_encoding:
+            return _dumps_rounded(obj, self._json_precision).encode('ascii')
+        return _dumps_rounded_by_token(obj, self._json_precision).encode('ascii')
+
+class XVIZJsonReader(XVIZBaseReader):
+    '''
+    Read messages written by XVIZJsonWriter as primitive objects (with dict and list)
+    '''
+    binary = False
+
+    def __init__(self, source):
+        super().__init__(source, suffix='-frame.json')
+
+    def _parse_message(self, data):
+        return json.loads(bytes(data))
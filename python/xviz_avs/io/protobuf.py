@@ -1,25 +1,129 @@
-from io import BytesIO
-from .base import XVIZBaseWriter
+from .base import XVIZBaseWriter, XVIZBaseReader
 
-from xviz_avs.message import XVIZEnvelope, XVIZMessage, Metadata
+from xviz_avs.message import XVIZEnvelope, XVIZMessage, Metadata, StateUpdate
+from xviz_avs.v2.envelope_pb2 import Envelope
+
+PBE_MAGIC = b'\x50\x42\x45\x31' # PBE1 in ASCII
 
 class XVIZProtobufWriter(XVIZBaseWriter):
-    def __init__(self, sink, wrap_envelope=True):
-        super().__init__(sink)
+    def __init__(self, sink, wrap_envelope=True, **kwargs):
+        '''
+        :param kwargs: background encoding options, see XVIZBaseWriter
+        '''
+        super().__init__(sink, suffix='.pbe', **kwargs)
         self._wrap_envelop = wrap_envelope
         self._counter = 2
 
-    def write_message(self, message: XVIZMessage, index: int = None):
-        self._check_valid()
-        if self._wrap_envelop:
-            obj = XVIZEnvelope(message).data
+    def _encode_message(self, message: XVIZMessage):
+        # the framed data is cached by the message and shared with other writers
+        return message.get_encoded(('pbe', self._wrap_envelop),
+                                   lambda: PBE_MAGIC + message.to_bytes(self._wrap_envelop))
+
+def _read_varint(buffer, pos):
+    result = shift = 0
+    while True:
+        byte = buffer[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+def _read_envelope_type(buffer):
+    '''
+    Scan the serialized Envelope for the `type` field without parsing the payload
+    '''
+    pos = 0
+    while pos < len(buffer):
+        tag, pos = _read_varint(buffer, pos)
+        field_number, wire_type = tag >> 3, tag & 7
+        if wire_type == 0: # varint
+            _, pos = _read_varint(buffer, pos)
+        elif wire_type == 1: # 64-bit
+            pos += 8
+        elif wire_type == 2: # length-delimited
+            length, pos = _read_varint(buffer, pos)
+            if field_number == 1:
+                return bytes(buffer[pos:pos + length]).decode('utf-8')
+            pos += length
+        elif wire_type == 5: # 32-bit
+            pos += 4
         else:
-            obj = message.data
+            raise ValueError("Unsupported wire type %d in envelope" % wire_type)
+    return ''
+
+class XVIZProtobufData:
+    '''
+    A PBE message read from source. Only the message type is read when it's asked for,
+    the payload is decoded when `message` is accessed for the first time.
+    '''
+    def __init__(self, data, message_type: str = None):
+        '''
+        :param data: bytes-like object with the PBE1 header
+        :param message_type: type of the message (e.g. 'xviz/state_update'). If specified,
+            the data is assumed to be not wrapped in Envelope.
+        '''
+        data = memoryview(data)
+        if data[:4] != PBE_MAGIC:
+            raise ValueError("Invalid PBE magic string")
+
+        self._data = data[4:]
+        self._wrapped = message_type is None
+        self._type = message_type
+        self._message = None
+
+    @property
+    def buffer(self) -> memoryview:
+        return self._data
+
+    @property
+    def wrapped(self) -> bool:
+        '''
+        Whether the buffer is a serialized Envelope
+        '''
+        return self._wrapped
 
-        data = BytesIO()
-        # write PBE1 header
-        data.write(b'\x50\x42\x45\x31')
-        data.write(obj.SerializeToString())
+    @property
+    def type(self) -> str:
+        if self._type is None:
+            self._type = _read_envelope_type(self._data)
+        return self._type
+
+    def has_message(self) -> bool:
+        return self._message is not None
+
+    @property
+    def message(self) -> XVIZMessage:
+        if self._message is None:
+            if self._wrapped:
+                envelope = Envelope.FromString(self._data)
+                self._type = envelope.type
+                self._message = XVIZEnvelope(envelope).to_message()
+            elif self._type == "xviz/metadata":
+                self._message = XVIZMessage(metadata=Metadata.FromString(self._data))
+            elif self._type == "xviz/state_update":
+                self._message = XVIZMessage(update=StateUpdate.FromString(self._data))
+            else:
+                raise ValueError("Unrecognized message type %s" % self._type)
+
+            if self._wrapped:
+                # the data read can be sent again without packing the message
+                self._message.get_encoded(('protobuf', True), lambda: bytes(self._data))
+        return self._message
+
+class XVIZProtobufReader(XVIZBaseReader):
+    '''
+    Read messages written by XVIZProtobufWriter. Messages are returned as XVIZProtobufData,
+    which decodes the payload lazily.
+    '''
+    def __init__(self, source, wrap_envelope=True):
+        super().__init__(source, suffix='-frame.pbe')
+        self._wrap_envelop = wrap_envelope
+
+    def read_metadata(self):
+        self._check_valid()
+        data = self._source.read(self._get_name(1))
+        return XVIZProtobufData(data, None if self._wrap_envelop else "xviz/metadata")
 
-        fname = self._get_sequential_name(message, index) + '.pbe'
-        self._source.write(data.getvalue(), fname)
+    def _parse_message(self, data):
+        return XVIZProtobufData(data, None if self._wrap_envelop else "xviz/state_update")
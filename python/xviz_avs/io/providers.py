@@ -0,0 +1,134 @@
+'''
+This module contains `providers` that give time-indexed access to the messages of a log.
+
+# Reference
+[@xviz/io/providers](https://github.com/uber/xviz/blob/master/modules/io/src/providers/xviz-base-provider.js)
+'''
+from bisect import bisect_left, bisect_right
+
+from xviz_avs.io.base import XVIZBaseReader
+from xviz_avs.io.json import XVIZJsonReader
+from xviz_avs.io.gltf import XVIZGLBReader
+from xviz_avs.io.protobuf import XVIZProtobufReader
+
+class XVIZBaseProvider:
+    '''
+    Provide messages of a log by timestamp. The message index (0-frame.json) is loaded once
+    and searched by bisection, so seeking doesn't need to read any message. Messages in the
+    log are expected to be in time order.
+    '''
+    def __init__(self, reader: XVIZBaseReader):
+        self._reader = reader
+        self._metadata = None
+        self._valid = False
+
+        index = reader.index
+        timing = index['timing'] if index else []
+        self._start_time, self._end_time = reader.time_range()
+        self._message_indices = [entry[2] for entry in timing]
+        self._min_times = [entry[0] for entry in timing]
+        self._max_times = [entry[1] for entry in timing]
+
+        try:
+            self._metadata = reader.read_metadata()
+        except (IOError, KeyError, ValueError):
+            return
+
+        if self._start_time is None and timing:
+            self._start_time = self._min_times[0]
+        if self._end_time is None and timing:
+            self._end_time = self._max_times[-1]
+        self._valid = len(timing) > 0
+
+    def valid(self) -> bool:
+        return self._valid
+
+    @property
+    def reader(self) -> XVIZBaseReader:
+        return self._reader
+
+    def xviz_metadata(self):
+        return self._metadata
+
+    def time_range(self):
+        return self._start_time, self._end_time
+
+    def message_count(self) -> int:
+        return len(self._message_indices)
+
+    def seek(self, timestamp: float) -> int:
+        '''
+        Find the position of the first message whose time range ends at or after `timestamp`.
+        Timestamps out of the log are clamped to the first or last message.
+
+        :return: position of the message in the log, which can be passed to `xviz_message`
+        '''
+        position = bisect_left(self._max_times, timestamp)
+        return min(position, self.message_count() - 1)
+
+    def get_message_iterator(self, start_time: float = None, end_time: float = None) -> range:
+        '''
+        Get the positions of the messages whose time range overlaps [start_time, end_time].
+        Times that are not specified default to the time range of the log.
+
+        :return: range of message positions, empty if no message is in the time range
+        '''
+        if start_time is None:
+            start_time = self._start_time
+        if end_time is None:
+            end_time = self._end_time
+        if start_time > end_time:
+            return range(0)
+
+        first = bisect_left(self._max_times, start_time)
+        last = bisect_right(self._min_times, end_time)
+        return range(first, max(first, last))
+
+    def message_time_range(self, position: int):
+        '''
+        Get the (min, max) timestamps of the message at `position` from the index
+        '''
+        return self._min_times[position], self._max_times[position]
+
+    def xviz_message(self, position: int):
+        '''
+        Read the message at `position` of the log
+        '''
+        return self._reader.read_message(self._message_indices[position])
+
+    def xviz_message_data(self, position: int):
+        '''
+        Read the message at `position` of the log as encoded data, e.g. to send it as is
+        '''
+        return self._reader.read_message_data(self._message_indices[position])
+
+    def iter_messages(self, start_time: float = None, end_time: float = None):
+        '''
+        Read the messages that overlap [start_time, end_time] in order. Messages out of the
+        time range are not read.
+        '''
+        for position in self.get_message_iterator(start_time, end_time):
+            yield self.xviz_message(position)
+
+    def close(self):
+        self._reader.close()
+
+class XVIZProviderFactory:
+    '''
+    Create a provider for a source by trying the registered reader classes in order.
+    '''
+    def __init__(self):
+        self._reader_classes = [XVIZGLBReader, XVIZProtobufReader, XVIZJsonReader]
+
+    def add_reader_class(self, reader_class):
+        self._reader_classes.append(reader_class)
+
+    def open(self, source) -> XVIZBaseProvider:
+        '''
+        :return: a valid provider or None if no reader supports the source
+        '''
+        for reader_class in self._reader_classes:
+            provider = XVIZBaseProvider(reader_class(source))
+            if provider.valid():
+                return provider
+        return None
@@ -4,6 +4,12 @@ Here the source is the combine definition of `source` and `sink` as from xviz JS
 '''
 import os
 import io
+import json
+import mmap
+import sqlite3
+import struct
+import threading
+import zipfile
 from collections import defaultdict
 
 class BaseSource:
@@ -43,16 +49,90 @@ class DirectorySource:
         pass
 
 class ZipSource:
-    pass
+    '''
+    Store the messages as members of a zip archive. In read mode the archive is memory mapped,
+    and members that are not compressed are returned as memoryview of the mapping without copy.
+    In write mode new members are appended to the archive, only the central directory is
+    rewritten on close.
+    '''
+    def __init__(self, path, mode='r', compression=zipfile.ZIP_STORED):
+        '''
+        :param path: path of the zip archive
+        :param mode: 'r' to read an existing archive, 'w' to create a new archive or 'a' to
+            append to an existing archive
+        :param compression: compression method of written members. Members compressed are
+            decompressed on read, so ZIP_STORED is preferred for binary messages.
+        '''
+        self._path = path
+        self._mode = mode
+        self._compression = compression
+        self._file = None
+        self._mmap = None
+
+        if mode == 'r':
+            self._file = open(path, 'rb')
+            if os.fstat(self._file.fileno()).st_size == 0:
+                # empty file cannot be mapped, and it's read as an archive without members
+                self._zip = None
+                self._members = {}
+                return
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._zip = zipfile.ZipFile(self._file)
+        else:
+            self._zip = zipfile.ZipFile(path, mode, compression=compression)
+
+        # Cache of the central directory
+        self._members = {info.filename: info for info in self._zip.infolist()}
+
+    def open(self, name, mode='r'):
+        if mode == 'r':
+            return self._zip.open(self._members[name])
+        elif mode == 'w':
+            info = zipfile.ZipInfo(name)
+            info.compress_type = self._compression
+            self._members[name] = info
+            return self._zip.open(info, mode='w', force_zip64=True)
+
+    def read(self, name):
+        info = self._members[name]
+        if self._mmap is None or info.compress_type != zipfile.ZIP_STORED:
+            return self._zip.read(info)
+
+        # Data of stored member is right after the local file header
+        name_len, extra_len = struct.unpack_from("<HH", self._mmap, info.header_offset + 26)
+        offset = info.header_offset + 30 + name_len + extra_len
+        return memoryview(self._mmap)[offset:offset + info.file_size]
+
+    def write(self, data, name):
+        info = zipfile.ZipInfo(name)
+        info.compress_type = self._compression
+        self._zip.writestr(info, data)
+        self._members[name] = info
+
+    def close(self):
+        if self._zip:
+            self._zip.close()
+            self._zip = None
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                pass # data read are still referenced, the mapping is released with them
+            self._mmap = None
+        if self._file:
+            self._file.close()
+            self._file = None
 
 class _BytesIOWrapper(io.BytesIO):
     '''
     This class is for wrap BytesIO in MemorySource
     '''
-    def __init__(self, source, key=None):
-        if key and key in source._data:
+    def __init__(self, source, key=None, mode=None):
+        if mode == 'w':
+            super().__init__()
+        elif key and key in source._data:
             super().__init__(source._data[key])
-        elif source._data:
+        elif not key and source._data:
             super().__init__(source._data)
         else:
             super().__init__()
@@ -78,9 +158,9 @@ class MemorySource:
 
     def open(self, name, mode=None):
         if self._latest_only:
-            return _BytesIOWrapper(self)
+            return _BytesIOWrapper(self, mode=mode)
         else:
-            return _BytesIOWrapper(self, name)
+            return _BytesIOWrapper(self, name, mode)
 
     def read(self, name=None):
         if self._latest_only:
@@ -97,5 +177,120 @@ class MemorySource:
     def close(self):
         del self._data
 
+class _SinkBytesIOWrapper(io.BytesIO):
+    '''
+    This class is for wrap BytesIO in sources that store the whole data upon close
+    '''
+    def __init__(self, source, key):
+        super().__init__()
+        self._source = source
+        self._key = key
+
+    def close(self):
+        if not self.closed:
+            self._source.write(bytes(self.getbuffer()), self._key)
+        super().close()
+
 class SQLiteSource:
-    pass
+    '''
+    Store the messages in a SQLite database as key-value pairs. When the message index
+    (0-frame.json) is written, the timings are also stored into an indexed table, so that
+    messages in a time range can be queried by `find_messages` without parsing the index.
+
+    Writes are grouped into transactions of `batch_size` messages, and the database is
+    opened in WAL mode, so writing a log doesn't sync the disk for every message.
+    '''
+    def __init__(self, path, batch_size=100, cached_statements=128):
+        '''
+        :param path: path of the database file, or ':memory:'
+        :param batch_size: number of messages written in one transaction
+        :param cached_statements: size of the prepared statement cache of the connection
+        '''
+        self._batch_size = batch_size
+        self._pending = {}
+        self._pending_timing = None
+        self._lock = threading.Lock()
+
+        # transactions are managed explicitly
+        self._conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False,
+                                     cached_statements=cached_statements)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS messages "
+                           "(name TEXT PRIMARY KEY, data BLOB NOT NULL)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS timing "
+                           "(name TEXT PRIMARY KEY, message_index INTEGER NOT NULL, "
+                           "start_time REAL NOT NULL, end_time REAL NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS timing_start_time ON timing (start_time)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS timing_end_time ON timing (end_time)")
+
+    def open(self, name, mode='r'):
+        if mode == 'r':
+            return io.BytesIO(self.read(name))
+        elif mode == 'w':
+            return _SinkBytesIOWrapper(self, name)
+
+    def read(self, name):
+        with self._lock:
+            if name in self._pending:
+                return self._pending[name]
+            row = self._conn.execute("SELECT data FROM messages WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            raise KeyError(name)
+        return row[0]
+
+    def write(self, data, name):
+        with self._lock:
+            self._pending[name] = bytes(data)
+            if name == '0-frame.json':
+                self._write_timing(json.loads(self._pending[name]))
+            if len(self._pending) >= self._batch_size:
+                self._flush()
+
+    def flush(self):
+        '''
+        Commit the pending messages into database
+        '''
+        with self._lock:
+            self._flush()
+
+    def find_messages(self, start_time, end_time):
+        '''
+        Query the messages whose time range overlaps [start_time, end_time]
+
+        :return: list of (message_index, name) in time order
+        '''
+        self.flush()
+        return self._conn.execute("SELECT message_index, name FROM timing "
+                                  "WHERE end_time >= ? AND start_time <= ? "
+                                  "ORDER BY message_index", (start_time, end_time)).fetchall()
+
+    def close(self):
+        if self._conn:
+            self.flush()
+            self._conn.close()
+            self._conn = None
+
+    def _flush(self):
+        if not self._pending:
+            return
+
+        self._conn.execute("BEGIN")
+        try:
+            self._conn.executemany("INSERT OR REPLACE INTO messages (name, data) VALUES (?, ?)",
+                                   self._pending.items())
+            if self._pending_timing is not None:
+                self._conn.execute("DELETE FROM timing")
+                self._conn.executemany("INSERT INTO timing (name, message_index, start_time, end_time) "
+                                       "VALUES (?, ?, ?, ?)", self._pending_timing)
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._pending.clear()
+        self._pending_timing = None
+
+    def _write_timing(self, index):
+        # timing entries are [min_time, max_time, message_index, name]
+        self._pending_timing = [(name, message_index, tmin, tmax)
+                                for tmin, tmax, message_index, name in index.get('timing', [])]
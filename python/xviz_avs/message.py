@@ -1,11 +1,14 @@
 import base64
-from typing import Union, Dict, List
+import math
+import numpy as np
+from typing import Union, Dict, List, Callable
 
 from xviz_avs.v2.core_pb2 import StreamSet
 from xviz_avs.v2.session_pb2 import StateUpdate, Metadata
 from xviz_avs.v2.options_pb2 import xviz_json_schema
 from xviz_avs.v2.envelope_pb2 import Envelope
 from google.protobuf.json_format import MessageToDict
+from google.protobuf.descriptor import FieldDescriptor
 
 def _unravel_list(list_: list, width: int) -> List[list]: # XXX: This is actually not used
     if len(list_) % width != 0:
@@ -23,6 +26,171 @@ def _unravel_style_object(style: dict):
     if 'stroke_color' in style:
         style['stroke_color'] = list(base64.b64decode(style['stroke_color']))
 
+_INT64_TYPES = (FieldDescriptor.CPPTYPE_INT64, FieldDescriptor.CPPTYPE_UINT64)
+
+def _float_to_object(value: float):
+    if math.isinf(value):
+        return '-Infinity' if value < 0 else 'Infinity'
+    if math.isnan(value):
+        return 'NaN'
+    return value
+
+_FLOAT32_MIN_NORMAL = float(np.finfo(np.float32).tiny)
+
+def _float32_to_object(value: float):
+    '''
+    Round a float field to the shortest decimal that reads back as the same float32,
+    with at least 6 significant digits as `MessageToDict` does
+    '''
+    if math.isinf(value) or math.isnan(value):
+        return _float_to_object(value)
+    target = np.float32(value)
+    if value == 0 or abs(value) >= _FLOAT32_MIN_NORMAL:
+        # for normal values, padding the shortest repr to 6 digits gives the same value
+        return float(str(target))
+
+    precision = 6
+    while True:
+        rounded = float('%.*g' % (precision, value))
+        if np.float32(rounded) == target:
+            return rounded
+        precision += 1
+
+# Below this size the per-value conversion is faster than the batched one
+_FLOAT32_BATCH_SIZE = 32
+
+def _float32_list_to_object(values) -> list:
+    '''
+    Convert repeated float fields (vertices etc.). This gives the same values as calling
+    `_float32_to_object` on each value, but rounds all the values to the same precision at once
+    and only retries the ones that don't survive the round trip with a higher precision.
+    '''
+    if len(values) < _FLOAT32_BATCH_SIZE:
+        return [_float32_to_object(v) for v in values]
+
+    original = np.array(values, dtype=np.float64)
+    if not np.isfinite(original).all():
+        return [_float32_to_object(v) for v in values]
+
+    target = original.astype(np.float32)
+    result = np.empty_like(original)
+    pending = np.arange(original.size)
+    precision = 6
+    while pending.size:
+        subset = original[pending]
+        text = ('%%.%dg ' % precision) * subset.size % tuple(subset.tolist())
+        rounded = np.fromiter(map(float, text.split()), np.float64, subset.size)
+        matched = rounded.astype(np.float32) == target[pending]
+        result[pending[matched]] = rounded[matched]
+        pending = pending[~matched]
+        precision += 1
+    return result.tolist()
+
+def _bytes_to_object(value: bytes):
+    return base64.b64encode(value).decode('utf-8')
+
+def _compile_value(field: FieldDescriptor, overrides: dict) -> Callable:
+    '''
+    Create the converter of a single (non-repeated) value of the field. The conversion rules
+    are the same as `MessageToDict` with `preserving_proto_field_name=True`.
+    '''
+    cpp_type = field.cpp_type
+    if cpp_type == FieldDescriptor.CPPTYPE_MESSAGE:
+        return _compile_message(field.message_type, overrides)
+    if cpp_type == FieldDescriptor.CPPTYPE_ENUM:
+        names = {value.number: value.name for value in field.enum_type.values}
+        return lambda value: names.get(value, value)
+    if cpp_type == FieldDescriptor.CPPTYPE_STRING:
+        return _bytes_to_object if field.type == FieldDescriptor.TYPE_BYTES else str
+    if cpp_type == FieldDescriptor.CPPTYPE_BOOL:
+        return bool
+    if cpp_type in _INT64_TYPES:
+        return str
+    if cpp_type == FieldDescriptor.CPPTYPE_FLOAT:
+        return _float32_to_object
+    if cpp_type == FieldDescriptor.CPPTYPE_DOUBLE:
+        return _float_to_object
+    return None # 32-bit integers are kept as is
+
+def _compile_field(field: FieldDescriptor, overrides) -> Callable:
+    '''
+    Create the converter of the whole field value, including repeated and map fields.
+
+    :param overrides: either a converter that replaces the default one, or a dict of overrides
+        for the fields of the nested message
+    '''
+    if callable(overrides):
+        return overrides
+
+    if field.message_type and field.message_type.GetOptions().map_entry:
+        value_field = field.message_type.fields_by_name['value']
+        convert = _compile_value(value_field, overrides)
+        if convert is None:
+            return lambda value: {str(k): value[k] for k in value}
+        return lambda value: {str(k): convert(value[k]) for k in value}
+
+    convert = _compile_value(field, overrides)
+    if field.is_repeated:
+        if convert is _float32_to_object:
+            return _float32_list_to_object
+        if convert is None:
+            return list
+        return lambda value: [convert(v) for v in value]
+    return convert
+
+_compiled_messages = {}
+
+def _compile_message(descriptor, overrides: dict = None) -> Callable:
+    '''
+    Create the converter from a message of the descriptor to dict, compiled from the
+    descriptor once so that no reflection is needed during conversion.
+
+    :param overrides: dict from field name to the overrides of that field (see `_compile_field`)
+    '''
+    if not overrides and descriptor.full_name in _compiled_messages:
+        return _compiled_messages[descriptor.full_name]
+
+    if descriptor.file.package == 'google.protobuf': # well-known types have special formats
+        return lambda message: MessageToDict(message, preserving_proto_field_name=True)
+
+    converters = {}
+    def convert(message):
+        js = {}
+        for field, value in message.ListFields():
+            field_convert = converters[field.name]
+            js[field.name] = value if field_convert is None else field_convert(value)
+        return js
+
+    if not overrides:
+        # register before compiling fields to support recursive messages
+        _compiled_messages[descriptor.full_name] = convert
+    for field in descriptor.fields:
+        converters[field.name] = _compile_field(field, (overrides or {}).get(field.name))
+    return convert
+
+_UNRAVELED_STYLE = {
+    'fill_color': list,
+    'stroke_color': list,
+}
+_UNRAVELED_PRIMITIVE = {'base': {'style': _UNRAVELED_STYLE}}
+_UNRAVELED_PRIMITIVES = {
+    field.name: _UNRAVELED_PRIMITIVE
+    for field in StreamSet.DESCRIPTOR.fields_by_name['primitives'] \
+        .message_type.fields_by_name['value'].message_type.fields
+}
+_UNRAVELED_PRIMITIVES['points'] = dict(_UNRAVELED_PRIMITIVE, colors=list)
+
+# Converters that produce the unraveled objects in one pass
+_stream_set_to_object = _compile_message(StreamSet.DESCRIPTOR, {
+    'primitives': _UNRAVELED_PRIMITIVES,
+})
+_metadata_to_object = _compile_message(Metadata.DESCRIPTOR, {
+    'streams': {
+        'stream_style': _UNRAVELED_STYLE,
+        'style_classes': {'style': _UNRAVELED_STYLE},
+    }
+})
+
 class XVIZFrame:
     '''
     This class is basically a wrapper around protobuf message `StreamSet`. It represent a frame of update.
@@ -37,25 +205,9 @@ class XVIZFrame:
         Serialize this data to primitive objects (with dict and list). Flattened arrays will
         be restored in this process.
         '''
-        dataobj = MessageToDict(self._data, preserving_proto_field_name=True)
         if not unravel:
-            return dataobj
-
-        if 'primitives' in dataobj:
-            for pdata in dataobj['primitives'].values():
-                # process colors
-                if 'points' in pdata:
-                    for pldata in pdata['points']:
-                        if 'colors' in pldata:
-                            pldata['colors'] = list(base64.b64decode(pldata['colors']))
-
-                # process styles
-                for pcats in pdata.values():
-                    for pldata in pcats:
-                        if 'base' in pldata and 'style' in pldata['base']:
-                            _unravel_style_object(pldata['base']['style'])
-                    
-        return dataobj
+            return MessageToDict(self._data, preserving_proto_field_name=True)
+        return _stream_set_to_object(self._data)
 
     @property
     def data(self) -> StreamSet:
@@ -63,12 +215,83 @@ class XVIZFrame:
 
 AllDataType = Union[StateUpdate, Metadata]
 
-class XVIZMessage:
+class _EncodingCache:
+    '''
+    Cache of the encoded forms (serialized bytes, writer outputs, etc.) of the wrapped protobuf
+    message, so that a message sent to multiple destinations is encoded only once.
+
+    Accessing `data` marks the message as modified, so the cache is dropped on the next lookup.
+    Since references to the message or its sub-messages can be kept, the lookups of a message
+    whose `data` has been handed out also compare its `ByteSize()` with the size the cache was
+    made from. Call `invalidate()` after modifying such a reference without changing the size.
+    Messages only read through `readonly_data` are never checked.
+    '''
+    def __init__(self):
+        self._data = None
+        self._encoded = {}
+        self._serialized = None # serialized message, cached apart from the other encodings
+        self._modified = False # `data` was accessed since the last lookup
+        self._shared = False # `data` was handed out, references to the message may be held
+        self._byte_size = None # size of the message the cache was made from, for shared messages
+
+    @property
+    def readonly_data(self):
+        '''
+        The wrapped protobuf message, which must not be modified
+        '''
+        return self._data
+
+    def _get_data(self):
+        self._modified = self._shared = True
+        return self._data
+
+    def invalidate(self):
+        '''
+        Drop all the cached encodings
+        '''
+        self._encoded.clear()
+        self._serialized = None
+        self._modified = False
+        self._byte_size = None
+
+    def _check_cache(self):
+        if not self._shared:
+            return
+        byte_size = self._data.ByteSize()
+        if self._modified or byte_size != self._byte_size:
+            self.invalidate()
+            self._byte_size = byte_size
+
+    def _serialize(self) -> bytes:
+        '''
+        Serialize the wrapped message. The same bytes object is returned as long as the message
+        is not modified.
+        '''
+        self._check_cache()
+        if self._serialized is None:
+            self._serialized = self._data.SerializeToString()
+        return self._serialized
+
+    def get_encoded(self, key, encoder: Callable):
+        '''
+        Get the encoding cached under `key`, which is created by `encoder` on the first request
+        and after the message is modified.
+
+        :param key: hashable identifier of the output format and options, e.g. ('json', True, 10)
+        :param encoder: function without arguments that returns the encoded data
+        '''
+        self._check_cache()
+        encoded = self._encoded.get(key)
+        if encoded is None:
+            encoded = self._encoded[key] = encoder()
+        return encoded
+
+class XVIZMessage(_EncodingCache):
     def __init__(self,
         update: StateUpdate = None,
         metadata: Metadata = None
     ):
-        self._data = None
+        super().__init__()
 
         if update:
             if not isinstance(update, StateUpdate):
@@ -89,7 +312,21 @@ class XVIZMessage:
 
     @property
     def data(self) -> AllDataType:
-        return self._data
+        '''
+        The wrapped protobuf message, the cached encodings are dropped when it's accessed
+        '''
+        return self._get_data()
+
+    def to_bytes(self, wrap_envelope: bool = False) -> bytes:
+        '''
+        Serialize the message with protobuf. The same bytes object is returned until the message
+        is modified.
+
+        :param wrap_envelope: serialize the message packed in `Envelope`
+        '''
+        if wrap_envelope:
+            return self.get_encoded(('protobuf', True), lambda: XVIZEnvelope(self).to_bytes())
+        return self._serialize()
 
     def to_object(self, unravel: bool = True) -> Dict:
         if not unravel:
@@ -101,38 +338,61 @@ class XVIZMessage:
                 'updates': [XVIZFrame(frame).to_object() for frame in self._data.updates]
             }
         elif isinstance(self._data, Metadata):
-            dataobj = MessageToDict(self._data, preserving_proto_field_name=True)
-
-            # process styles
-            if 'streams' in dataobj:
-                for sdata in dataobj['streams'].values():
-                    if 'stream_style' in sdata:
-                        _unravel_style_object(sdata['stream_style'])
-                    if 'style_classes' in sdata:
-                        for style_class in sdata['style_classes']:
-                            _unravel_style_object(style_class['style'])
-
-            return dataobj
-
-class XVIZEnvelope:
-    def __init__(self, data: Union[XVIZMessage, AllDataType]):
-        if isinstance(data, XVIZMessage):
-            type_str = data.get_schema()
-            data = data.data
-        else:
-            type_str = XVIZMessage(data).get_schema()
+            return _metadata_to_object(self._data)
+
+_TYPE_URL_PREFIX = 'type.googleapis.com/'
+
+class XVIZEnvelope(_EncodingCache):
+    def __init__(self, data: Union[XVIZMessage, AllDataType, Envelope]):
+        super().__init__()
+        self._message = None
+        self._payload = None
+
+        if isinstance(data, Envelope): # already packed
+            self._data = data
+            return
 
-        self._type = type(data)
-        self._data = Envelope(type=type_str.replace("session", "xviz"))
-        self._data.data.Pack(data)
+        if not isinstance(data, XVIZMessage):
+            data = XVIZMessage(metadata=data) if isinstance(data, Metadata) else XVIZMessage(update=data)
+
+        self._data = Envelope(type=data.get_schema().replace("session", "xviz"))
+        self._data.data.type_url = _TYPE_URL_PREFIX + data.readonly_data.DESCRIPTOR.full_name
+        self._message = data
+        self._pack()
+
+    def _pack(self):
+        # the payload is shared with the serialization cache of the message
+        self._payload = self._message.to_bytes()
+        self._data.data.value = self._payload
+
+    def _sync(self):
+        '''
+        Repack the message if it's modified after being packed
+        '''
+        if self._message is not None and self._message.to_bytes() is not self._payload:
+            self._pack()
+            self.invalidate()
 
     @property
     def data(self) -> Envelope:
+        self._sync()
+        return self._get_data()
+
+    @property
+    def readonly_data(self) -> Envelope:
+        self._sync()
         return self._data
 
+    def to_bytes(self) -> bytes:
+        '''
+        Serialize the envelope with protobuf. The result is cached until the message is modified.
+        '''
+        self._sync()
+        return self.get_encoded('protobuf', self._data.SerializeToString)
+
     def to_object(self, unravel: bool = True) -> Dict:
         if not unravel:
-            return MessageToDict(self._data, preserving_proto_field_name=True)
+            return MessageToDict(self.readonly_data, preserving_proto_field_name=True)
 
         return {
             "type": self._data.type,
@@ -140,13 +400,27 @@ class XVIZEnvelope:
         }
 
     def to_message(self) -> XVIZMessage:
+        '''
+        Get the packed message. The message is unpacked only once and shared with the envelope,
+        so that modifying it updates the envelope. The message is unpacked again if the envelope
+        payload is modified directly.
+        '''
+        self._sync()
+        if self._message is not None and self._data.data.value == self._payload:
+            return self._message
+
         if self._data.type == "xviz/metadata":
             udata = Metadata()
             self._data.data.Unpack(udata)
-            return XVIZMessage(metadata=udata)
+            message = XVIZMessage(metadata=udata)
         elif self._data.type == "xviz/state_update":
             udata = StateUpdate()
             self._data.data.Unpack(udata)
-            return XVIZMessage(update=udata)
+            message = XVIZMessage(update=udata)
         else:
             raise ValueError("Unrecognized envelope data")
+
+        # the payload is the serialized message, so it's not serialized again when unchanged
+        self._payload = message._serialized = self._data.data.value
+        self._message = message
+        return message
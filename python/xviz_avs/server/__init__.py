@@ -1,3 +1,6 @@
 from .server import XVIZServer
 from .handlers import XVIZLogPlayHandler
 from .sessions import XVIZBaseSession, XVIZLogPlaySession
+from .prefetch import XVIZPrefetcher
+from .cache import XVIZFrameCache
+from .broadcast import XVIZBroadcaster, XVIZBroadcastSession
@@ -0,0 +1,124 @@
+import asyncio
+import logging
+from collections import deque
+
+from .sessions import XVIZBaseSession
+
+class XVIZSubscriber:
+    '''
+    Queue of the frames broadcast to one session. When the queue is full the oldest frame
+    is dropped, so a slow client skips frames instead of stalling the other clients.
+    '''
+    def __init__(self, max_queue_size: int = 8):
+        self._queue = deque(maxlen=max_queue_size)
+        self._event = asyncio.Event()
+        self._finished = False
+        self.dropped_count = 0
+
+    def put(self, data):
+        if len(self._queue) == self._queue.maxlen:
+            self.dropped_count += 1
+        self._queue.append(data)
+        self._event.set()
+
+    def finish(self):
+        self._finished = True
+        self._event.set()
+
+    async def get(self):
+        '''
+        Wait for the next frame
+
+        :return: the frame, or None if the broadcast is finished
+        '''
+        while not self._queue:
+            if self._finished:
+                return None
+            self._event.clear()
+            await self._event.wait()
+        return self._queue.popleft()
+
+class XVIZBroadcaster:
+    '''
+    Run one producer for all the subscribed sessions. Each frame is built and encoded once by
+    the producer and the same data is pushed to every subscriber. The producer is started with
+    the first subscriber and stopped when the last one leaves.
+    '''
+    def __init__(self, producer, metadata=None, max_queue_size: int = 8, logger=None):
+        '''
+        :param producer: function without arguments that returns an async iterator of the
+            encoded frames (bytes or str) to be sent
+        :param metadata: encoded metadata sent to each subscriber before the frames
+        :param max_queue_size: number of frames queued for each subscriber before the oldest
+            ones are dropped
+        '''
+        self._producer = producer
+        self._max_queue_size = max_queue_size
+        self._subscribers = []
+        self._task = None
+        self._logger = logger or logging.getLogger('xviz-server')
+        self.metadata = metadata
+        self.frame_count = 0
+
+    @property
+    def subscriber_count(self) -> int:
+        return len(self._subscribers)
+
+    def subscribe(self) -> XVIZSubscriber:
+        subscriber = XVIZSubscriber(self._max_queue_size)
+        self._subscribers.append(subscriber)
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+        return subscriber
+
+    def unsubscribe(self, subscriber: XVIZSubscriber):
+        self._subscribers.remove(subscriber)
+        if not self._subscribers and self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        try:
+            async for data in self._producer():
+                self.frame_count += 1
+                for subscriber in self._subscribers:
+                    subscriber.put(data)
+        except Exception:
+            self._logger.exception("[> Broadcast] producer failed")
+        finally:
+            for subscriber in self._subscribers:
+                subscriber.finish()
+            if self._task is asyncio.current_task():
+                self._task = None
+
+class XVIZBroadcastSession(XVIZBaseSession):
+    '''
+    This class holds a session receiving the frames of a XVIZBroadcaster
+    '''
+    def __init__(self, socket, request, broadcaster: XVIZBroadcaster, logger=None):
+        super().__init__(socket, request, logger)
+        self._broadcaster = broadcaster
+
+    def on_connect(self):
+        self._logger.info("[> Broadcast] subscribed, %d sessions",
+            self._broadcaster.subscriber_count + 1)
+
+    def on_disconnect(self):
+        self._logger.info("[> Broadcast] unsubscribed")
+
+    async def main(self):
+        subscriber = self._broadcaster.subscribe()
+        try:
+            if self._broadcaster.metadata is not None:
+                await self._socket.send(self._broadcaster.metadata)
+
+            while True:
+                data = await subscriber.get()
+                if data is None:
+                    break
+                await self._socket.send(data)
+        finally:
+            self._broadcaster.unsubscribe(subscriber)
+            if subscriber.dropped_count:
+                self._logger.info("[> Broadcast] %d frames dropped for slow client",
+                    subscriber.dropped_count)
@@ -0,0 +1,93 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+def frame_size(data) -> int:
+    '''
+    Size in bytes of a frame as sent, text frames are counted in UTF-8
+    '''
+    return len(data.encode('utf-8')) if isinstance(data, str) else len(data)
+
+class XVIZFrameCache:
+    '''
+    LRU cache of encoded frames shared by the sessions of a server, with a budget in bytes.
+    Frames are keyed by (log path, frame index, output format). Concurrent requests of a frame
+    that is being loaded wait for that load instead of loading it again.
+
+    This class is thread-safe, frames are usually loaded in the reading threads of sessions.
+    '''
+    def __init__(self, max_bytes: int = 256 << 20):
+        '''
+        :param max_bytes: maximum total size of the cached frames, frames larger than this
+            are not cached
+        '''
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # key -> (data, size), from least to most recently used
+        self._loading = {} # key -> Future of the load in progress
+        self._bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.coalesced = 0
+
+    @property
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses, evictions=self.evictions,
+                        coalesced=self.coalesced, entries=len(self._entries), bytes=self._bytes)
+
+    def get(self, key, load):
+        '''
+        Get the frame of `key`, calling `load` to read it if it's not cached yet
+
+        :param key: tuple of (log path, frame index, output format)
+        :param load: function without arguments that returns the frame as bytes or str
+        '''
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0]
+
+            waiting = self._loading.get(key)
+            if waiting is not None:
+                self.coalesced += 1
+            else:
+                self.misses += 1
+                future = self._loading[key] = Future()
+
+        if waiting is not None: # loaded by another thread
+            return waiting.result()
+
+        try:
+            data = load()
+        except BaseException as e:
+            with self._lock:
+                del self._loading[key]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            del self._loading[key]
+            self._put(key, data)
+        future.set_result(data)
+        return data
+
+    def _put(self, key, data):
+        size = frame_size(data)
+        if size > self._max_bytes:
+            return
+
+        self._entries[key] = (data, size)
+        self._bytes += size
+        while self._bytes > self._max_bytes:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self._bytes -= evicted_size
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
@@ -1,15 +1,38 @@
 import os
 from .sessions import XVIZLogPlaySession
+from xviz_avs.io import DirectorySource, XVIZProviderFactory
 
 class XVIZLogPlayHandler:
-    def __init__(self, root=None):
+    def __init__(self, root=None, **session_options):
         '''
         :param root: root path of the files
+        :param session_options: read ahead options of the sessions, see XVIZLogPlaySession
         '''
         self._root = root
+        self._session_options = session_options
+        self._factory = XVIZProviderFactory()
+        self._frame_cache = None
+
+    def set_frame_cache(self, frame_cache):
+        '''
+        Read the logs through the frame cache shared by the sessions of the server
+        '''
+        self._frame_cache = frame_cache
 
     def __call__(self, socket, request):
-        directory = os.path.join(self._root, request.path) if self._root else request.path
-        reader = None # XXXReader(directory)
-        session = XVIZLogPlaySession(socket, request, reader)
+        if self._root:
+            root = os.path.realpath(self._root)
+            directory = os.path.realpath(os.path.join(root, request.path.lstrip('/')))
+            if os.path.commonpath([root, directory]) != root: # out of root
+                return None
+        else:
+            directory = request.path
+        if not os.path.isdir(directory):
+            return None
+
+        provider = self._factory.open(DirectorySource(directory))
+        if provider is None:
+            return None
+        session = XVIZLogPlaySession(socket, request, provider, frame_cache=self._frame_cache,
+            log_path=os.path.realpath(directory), **self._session_options)
         return session
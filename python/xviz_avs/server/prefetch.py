@@ -0,0 +1,104 @@
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .cache import frame_size
+
+# Default number of messages read ahead of the playback
+DEFAULT_READ_AHEAD = 4
+
+class XVIZPrefetcher:
+    '''
+    Load the upcoming messages of a playback in background threads, so that reading and
+    encoding don't happen on the send path. The window of loaded messages is bounded by both
+    message count and bytes, and it's dropped and refilled when the playback seeks.
+
+    This class must be used from the event loop thread.
+    '''
+    def __init__(self, load, max_messages: int = DEFAULT_READ_AHEAD, max_bytes: int = 64 << 20,
+                 workers: int = 2):
+        '''
+        :param load: function taking the position of a message and returning the data to send,
+            it's called in the worker threads
+        :param max_messages: maximum number of messages being loaded or waiting to be taken
+        :param max_bytes: maximum size of the window. The size of the messages being loaded is
+            estimated by the size of the last taken message.
+        :param workers: number of loading threads
+        '''
+        if max_messages < 1:
+            raise ValueError("At least one message should be prefetched")
+        self._load = load
+        self._max_messages = max_messages
+        self._max_bytes = max_bytes
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="xviz-prefetch")
+
+        self._positions = iter(())
+        self._window = deque() # (position, future) in playback order
+        self._message_size = 0
+
+    @property
+    def loaded_bytes(self) -> int:
+        '''
+        Size of the loaded messages in the window
+        '''
+        return sum(frame_size(future.result()) for _, future in self._window
+                   if future.done() and not future.cancelled() and future.exception() is None)
+
+    def _window_bytes(self) -> int:
+        loading = sum(1 for _, future in self._window if not future.done())
+        return self.loaded_bytes + loading * self._message_size
+
+    @property
+    def window_size(self) -> int:
+        return len(self._window)
+
+    def seek(self, positions):
+        '''
+        Drop the current window and start loading from the new positions
+
+        :param positions: iterable of message positions to be played in order
+        '''
+        for _, future in self._window:
+            future.cancel()
+        self._window.clear()
+        self._positions = iter(positions)
+        self._fill()
+
+    def _fill(self):
+        loop = asyncio.get_running_loop()
+        window_bytes = self._window_bytes()
+        while len(self._window) < self._max_messages and window_bytes < self._max_bytes:
+            position = next(self._positions, None)
+            if position is None:
+                return
+
+            future = loop.run_in_executor(self._executor, self._load, position)
+            self._window.append((position, future))
+            window_bytes += self._message_size
+
+    async def next(self):
+        '''
+        Wait for the next message of the playback. Seeking while waiting switches to the
+        first message of the new positions.
+
+        :return: tuple of (position, data), or None if there are no more messages
+        '''
+        while True:
+            if not self._window:
+                return None
+            position, future = self._window[0]
+            await asyncio.wait([future])
+            if self._window and self._window[0][1] is future:
+                break
+
+        self._window.popleft()
+        data = future.result() # raise the errors of loading
+        self._message_size = frame_size(data)
+        self._fill()
+        return position, data
+
+    def close(self):
+        for _, future in self._window:
+            future.cancel()
+        self._window.clear()
+        self._executor.shutdown(wait=False)
@@ -5,10 +5,14 @@ import websockets
 from websockets.exceptions import ConnectionClosed
 import traceback
 
+from .cache import XVIZFrameCache
+
 class XVIZServer:
-    def __init__(self, handlers, port=3000, per_message_deflate=True):
+    def __init__(self, handlers, port=3000, per_message_deflate=True, frame_cache_bytes=256 << 20):
         '''
         :param handlers: single or list of handlers that acts as function and return a session object, or None if not supported
+        :param frame_cache_bytes: size of the frame cache shared by the sessions. Handlers that
+            have `set_frame_cache` method are given the cache.
         '''
         if not handlers:
             raise ValueError("No handler is registered!")
@@ -18,6 +22,10 @@ class XVIZServer:
             self._handlers = handlers
 
         self._logger = logging.getLogger("xviz-server")
+        self._frame_cache = XVIZFrameCache(frame_cache_bytes)
+        for handler in self._handlers:
+            if hasattr(handler, 'set_frame_cache'):
+                handler.set_frame_cache(self._frame_cache)
         self._connections = []
 
         compression = "deflate" if per_message_deflate else None
@@ -55,5 +63,9 @@ class XVIZServer:
         await socket.close()
         self._logger.info("[> Connection] closed due to no handler found")
 
+    @property
+    def frame_cache(self) -> XVIZFrameCache:
+        return self._frame_cache
+
     def serve(self):
         return websockets.serve(**self._serve_options)
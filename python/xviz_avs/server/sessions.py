@@ -1,4 +1,9 @@
+import asyncio
+import json
 import logging
+from websockets.exceptions import ConnectionClosed
+
+from .prefetch import XVIZPrefetcher, DEFAULT_READ_AHEAD
 
 class XVIZBaseSession:
     def __init__(self, socket, request, logger=None):
@@ -26,11 +31,38 @@ class XVIZBaseSession:
 
 class XVIZLogPlaySession(XVIZBaseSession):
     '''
-    This class holds a session playing autonomy data from files
+    This class holds a session playing autonomy data from files. The metadata is sent first,
+    then the messages are sent as they are stored, paced by their timestamps in the index.
+
+    Supported request parameters:
+    - start_time: log time to start playing from, defaults to the start of the log
+    - duration: length of the played time range in seconds, defaults to the end of the log
+
+    The client can seek by sending `xviz/transform_log` messages with `start_timestamp` and
+    `end_timestamp`.
     '''
-    def __init__(self, socket, request, reader, logger=None):
+    def __init__(self, socket, request, provider, logger=None,
+                 read_ahead=DEFAULT_READ_AHEAD, read_ahead_bytes=64 << 20, read_workers=2,
+                 frame_cache=None, log_path=None):
+        '''
+        :param provider: XVIZBaseProvider of the log
+        :param read_ahead: maximum number of messages read but not sent yet. Messages are not
+            read further while the websocket is waiting for its send buffer to drain.
+        :param read_ahead_bytes: maximum size of the messages read but not sent yet
+        :param read_workers: number of threads reading the messages
+        :param frame_cache: XVIZFrameCache shared with other sessions, messages are read
+            through it if `log_path` is also specified
+        :param log_path: path identifying the log in the frame cache
+        '''
         super().__init__(socket, request, logger)
-        self._reader = reader
+        self._provider = provider
+        self._frame_cache = frame_cache if log_path is not None else None
+        self._log_path = log_path
+        self._prefetcher = XVIZPrefetcher(self._read_message,
+            max_messages=read_ahead, max_bytes=read_ahead_bytes, workers=read_workers)
+        self._start_clock = None
+        self._start_timestamp = None
+        self._seeked = None # asyncio.Event set on each seek, created in the event loop
 
     def on_connect(self):
         print("LogPlayer connected!")
@@ -38,6 +70,97 @@ class XVIZLogPlaySession(XVIZBaseSession):
     def on_disconnect(self):
         print("LogPlayer disconnected!")
 
+    def _get_time_range(self):
+        start_time = self._request.get('start_time')
+        start_time = float(start_time) if start_time is not None else self._provider.time_range()[0]
+        duration = self._request.get('duration')
+        end_time = start_time + float(duration) if duration is not None else None
+        return start_time, end_time
+
+    def _read_data(self, frame, read, *args):
+        def load():
+            data = read(*args)
+            if not self._provider.reader.binary:
+                data = bytes(data).decode('utf-8') # sent as text frame
+            return data
+
+        if self._frame_cache is None:
+            return load()
+        return self._frame_cache.get((self._log_path, frame, self._provider.reader.suffix), load)
+
+    def _read_message(self, position):
+        return self._read_data(position, self._provider.xviz_message_data, position)
+
+    def seek(self, start_time: float = None, end_time: float = None):
+        '''
+        Play the messages in the time range from now on
+        '''
+        self._prefetcher.seek(self._provider.get_message_iterator(start_time, end_time))
+        self._start_clock = None
+        if self._seeked is not None:
+            self._seeked.set()
+
+    async def _receive_requests(self):
+        while True:
+            try:
+                request = await self._socket.recv()
+            except ConnectionClosed:
+                return
+
+            try:
+                request = json.loads(request)
+                if request.get('type') == 'xviz/transform_log':
+                    data = request.get('data', {})
+                    start_time, end_time = data.get('start_timestamp'), data.get('end_timestamp')
+                    self.seek(None if start_time is None else float(start_time),
+                              None if end_time is None else float(end_time))
+            except (ValueError, TypeError, AttributeError):
+                self._logger.warning("Ignored invalid request from client: %s", request)
+
     async def main(self):
-        raise NotImplementedError() # TODO: read data and send to client
-        
\ No newline at end of file
+        try:
+            await self._play()
+        finally:
+            self._prefetcher.close()
+            self._provider.close()
+
+    async def _play(self):
+        try:
+            start_time, end_time = self._get_time_range()
+        except ValueError:
+            self._logger.error("Invalid time range in request: %s", self._request)
+            await self._socket.close()
+            return
+
+        loop = asyncio.get_running_loop()
+        self._seeked = asyncio.Event()
+        metadata = await loop.run_in_executor(None, self._read_data,
+            'metadata', self._provider.reader.read_metadata_data)
+        await self._socket.send(metadata)
+
+        self.seek(start_time, end_time)
+        receiver = asyncio.ensure_future(self._receive_requests())
+        try:
+            while True:
+                item = await self._prefetcher.next()
+                if item is None:
+                    break
+
+                position, data = item
+                timestamp = self._provider.message_time_range(position)[0]
+                if self._start_clock is None:
+                    self._start_clock, self._start_timestamp = loop.time(), timestamp
+                delay = self._start_clock + (timestamp - self._start_timestamp) - loop.time()
+                if delay > 0:
+                    # a seek interrupts the wait, the message is then dropped
+                    self._seeked.clear()
+                    try:
+                        await asyncio.wait_for(self._seeked.wait(), delay)
+                        continue
+                    except asyncio.TimeoutError:
+                        pass
+
+                # this waits until the send buffer is drained, which stops the reading as well
+                await self._socket.send(data)
+        finally:
+            receiver.cancel()